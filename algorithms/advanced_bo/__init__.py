@@ -4,21 +4,22 @@ import time
 from operator import itemgetter
 from .modules.bayes_optimization import BayesOpt
 from .modules.OnlineGP import OGP
+from .modules.scan_params import read_scan_params
 
 
 def optimize(evaluate, params):
     scan_params_name, n_iter = itemgetter(
         'scan_params_name', 'n_iter')(params)
 
-    scan_params_filename = f'{scan_params_name}.npy'
-
     # Load the dict that contains the parameters for the scan (control pv list, starting settings, and gp hyperparams)
+    # from the .npz file, see modules/scan_params.py
     algo_root = os.path.dirname(os.path.realpath(__file__))
-    if scan_params_filename.startswith('/'):
-        full_path = scan_params_filename
+    if scan_params_name.startswith('/'):
+        full_path = scan_params_name
     else:
-        full_path = os.path.join(algo_root, 'params', scan_params_filename)
-    scan_params = np.load(full_path, allow_pickle=True).item()
+        full_path = os.path.join(algo_root, 'params', scan_params_name)
+    scan_params = read_scan_params(full_path, keys=[
+        'acquisition_delay', 'start_point', 'gp_precisionmat', 'ucb_params'])
 
     # How long to wait between acquisitions
     acquisition_delay = scan_params['acquisition_delay']
@@ -38,12 +39,28 @@ def optimize(evaluate, params):
     hyps = [gp_precisionmat, np.log(gp_amp), np.log(gp_noise)]  # format the hyperparams for the OGP
     gp = OGP(ndim, hyps)
 
+    # Data from earlier runs to seed the gp with, rows of settings followed by
+    # the objective. batch_fit builds the gp from all of it at once: much
+    # faster, but less accurate than fitting row by row (see OGP.batchFit)
+    prior_data = params.get('prior_data')
+    if prior_data is not None:
+        if not prior_data.startswith('/'):
+            prior_data = os.path.join(algo_root, 'params', prior_data)
+        prior_data = np.load(prior_data, allow_pickle=False)
+
     # Create the bayesian optimizer that will use the gp as the model to optimize the machine
-    opt = BayesOpt(gp, evaluate, acq_func='UCB', start_dev_vals=start_point)
+    opt = BayesOpt(gp, evaluate, acq_func='UCB', start_dev_vals=start_point,
+                   prior_data=prior_data, batchFitQ=params.get('batch_fit', False))
     opt.ucb_params = scan_params['ucb_params']  # set the acquisition function parameters
+    opt.acq_mode = params.get('acq_mode', 'grid')
+    opt.time_budget = params.get('time_budget')  # seconds per acquisition, None for no limit
+    opt.pipelineQ = params.get('pipeline', False)  # acquire the next point while the machine settles
 
     # Running BO
-    for i in range(n_iter):
-        # print('iteration =', i)
-        opt.OptIter()
-        time.sleep(acquisition_delay)
+    try:
+        for i in range(n_iter):
+            # print('iteration =', i)
+            opt.OptIter()
+            time.sleep(acquisition_delay)
+    finally:
+        opt.close()
@@ -30,12 +30,34 @@ Initialization parameters:
         yield improved performance. Still testing.
     thresh: some low float value to specify how different a point has to be to
         add it to the model. Keeps matrices well-conditioned.
+    choleskyQ: whether to keep a Cholesky factor of the Gram matrix, updated
+        by rank-one operations, instead of solving against it at each update.
+        Makes updates and BV removals O(m^2) instead of O(m^3). Pays off
+        from about 30 BVs on (2x faster at maxBV 100, 8x at 1000, see
+        benchmark_ogp.benchmarkUpdates), below that it is up to 1.4x slower.
+    backend: how kernels are evaluated, 'numpy', 'numexpr' or 'numba', see
+        kernels.py. The latter two need the corresponding package. Can be
+        changed at any time.
+    float32Q: whether predictBatch and predictGrad evaluate the kernel in
+        single precision, which is faster for many points. The model itself
+        is always kept in double precision.
 
 Methods:
     update(x_new, y_new): Runs an online GP iteration incorporating the new data.
-    fit(X, Y): Calls update on multiple points for convenience. X is assumed to
-        be a pandas DataFrame.
+    fit(X, Y): Trains on multiple points for convenience. X is assumed to
+        be a pandas DataFrame. Calls update on each point, or builds an
+        empty model with batchFit if batchQ is True.
+    batchFit(X, Y): Builds the model from many points at once, with greedy
+        BV selection and a single factorization. Much faster than updating
+        row by row but less accurate when there are many more points than
+        maxBV, see the method.
     predict(x): Computes GP prediction(s) for input point(s).
+    predictBatch(x): Same as predict but only returns the marginal variance
+        of each point, which is much cheaper for many points.
+    predictGrad(x): Same as predictBatch but also returns the gradients of
+        the mean and variance with respect to the input point(s).
+    computeCov(x1, x2): Covariance matrix of two sets of points, optionally
+        written into a given output array whose dtype selects the precision.
     scoreBVs(): Returns a vector with the (either weighted or unweighted) KL
         divergence-cost of removing each BV.
     deleteBV(index): Removes the selected BV from the GP and updates to minimize
@@ -68,17 +90,55 @@ Change log:
 import numpy as np
 import numbers
 from numpy.linalg import solve, inv
-import collections
+from scipy.linalg import solve_triangular, cho_solve
+from .kernels import Kernel
+
+_stateNames = ['BV', 'alpha', 'C', 'KB', 'KBinv', 'KBchol']
+
+class _ActiveBlock(object):
+    # exposes the active block of one of the OGP state buffers. Assigning
+    #   copies into the buffer, assigning BV also sets the number of BVs
+
+    def __init__(self, bufname, squareQ):
+        self.bufname = bufname
+        self.squareQ = squareQ
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        n = obj.numBV
+        buf = obj.__dict__[self.bufname]
+        if(self.squareQ):
+            return buf[:n,:n]
+        return buf[:n]
+
+    def __set__(self, obj, value):
+        value = np.asarray(value, dtype=float)
+        if(self.bufname == '_BVbuf'):
+            value = value.reshape((-1,obj.nin))
+        elif(not self.squareQ):
+            value = value.reshape((-1,1))
+        n = value.shape[0]
+        obj._reserve(n)
+        if(self.bufname == '_BVbuf'):
+            obj.numBV = n
+        if(self.squareQ):
+            obj.__dict__[self.bufname][:n,:n] = value
+        else:
+            obj.__dict__[self.bufname][:n] = value
 
 class OGP(object):
     def __init__(self, dim, hyperparams, covar='RBF_ARD', maxBV=200,
-                 prmean=None, prmeanp=None, prvar=None, prvarp=None, proj=True, weighted=False, thresh=1e-6, sparsityQ = True):
+                 prmean=None, prmeanp=None, prvar=None, prvarp=None, proj=True, weighted=False, thresh=1e-6, sparsityQ = True, choleskyQ = True, backend='numpy', float32Q = False):
         self.nin = dim
         self.maxBV = maxBV
         self.numBV = 0
         self.proj = proj
         self.weighted = weighted
         self.sparsityQ = sparsityQ
+        self.choleskyQ = choleskyQ
+        self.backend = backend
+        self.float32Q = float32Q
         self.verboseQ = False
         self.nupdates = 0
 
@@ -101,16 +161,61 @@ class OGP(object):
         self.prmean = prmean; self.prmeanp = prmeanp
         self.prvar = prvar; self.prvarp = prvarp
 
-        # initialize model state
-        self.BV = np.zeros(shape=(0,self.nin))
-        self.alpha = np.zeros(shape=(0,1))
-        self.C = np.zeros(shape=(0,0))
-
-        self.KB = np.zeros(shape=(0,0))
-        self.KBinv = np.zeros(shape=(0,0))
+        # initialize model state: BV, alpha, C, KB, KBinv and KBchol (the
+        #   lower Cholesky factor of KB) are views of the active numBV block
+        #   of buffers which are allocated once. The sparse model never holds
+        #   more than maxBV + 1 BVs, the full one doubles its buffers if needed
+        self.capacity = 0
+        self._allocate(maxBV + 1 if sparsityQ else 64)
 
         self.thresh = thresh
 
+        # kernel objects by type, and the scratch buffer of predictBatch and
+        #   predictGrad, neither is pickled
+        self._kernels = {}
+        self._kxbuf = None
+
+    # model state, views of the active block of the buffers
+    BV = _ActiveBlock('_BVbuf', squareQ=False)
+    alpha = _ActiveBlock('_alphabuf', squareQ=False)
+    C = _ActiveBlock('_Cbuf', squareQ=True)
+    KB = _ActiveBlock('_KBbuf', squareQ=True)
+    KBinv = _ActiveBlock('_KBinvbuf', squareQ=True)
+    KBchol = _ActiveBlock('_KBcholbuf', squareQ=True)
+
+    def _allocate(self, capacity):
+        # allocates zeroed state buffers and copies the active block over
+        active = [(name, getattr(self, name)) for name in _stateNames] if self.numBV else []
+
+        self._BVbuf = np.zeros(shape=(capacity,self.nin))
+        self._alphabuf = np.zeros(shape=(capacity,1))
+        self._Cbuf = np.zeros(shape=(capacity,capacity))
+        self._KBbuf = np.zeros(shape=(capacity,capacity))
+        self._KBinvbuf = np.zeros(shape=(capacity,capacity))
+        self._KBcholbuf = np.zeros(shape=(capacity,capacity))
+        self.capacity = capacity
+
+        for (name, value) in active:
+            setattr(self, name, value)
+
+    def _reserve(self, numBV):
+        # makes sure the buffers can hold numBV BVs
+        if(numBV > self.capacity):
+            self._allocate(max(numBV, 2 * self.capacity))
+
+    def _compact(self, removeInd):
+        # removes a BV from the buffers in place by shifting the following
+        #   rows and columns up by one, so the BV order (and the triangular
+        #   structure of KBchol) is preserved
+        n = self.numBV
+        i = removeInd
+        self._BVbuf[i:n-1] = self._BVbuf[i+1:n]
+        self._alphabuf[i:n-1] = self._alphabuf[i+1:n]
+        for M in [self._Cbuf, self._KBbuf, self._KBinvbuf, self._KBcholbuf]:
+            M[i:n-1,:n] = M[i+1:n,:n]
+            M[:n-1,i:n-1] = M[:n-1,i+1:n]
+        self.numBV = n - 1
+
     def __getstate__(self):
         # Copy the object's state from self.__dict__ which contains
         # all our instance atributes. Always use the dict.copy()
@@ -120,23 +225,116 @@ class OGP(object):
         # Remove unpicklable entries (these would need to be recreated
         # in the __setstate__ function. 
         # Example: del state['file'] # since the file handle isn't pickleable
+        del state['_kernels']
+        del state['_kxbuf']
         
         return state
         
     def __setstate__(self, state):
         # Restore instance attributes
         self.__dict__.update(state)
+
+        # models pickled before the preallocated buffers, their state
+        #   matrices are plain attributes
+        if '_BVbuf' not in state:
+            old = dict((name, self.__dict__.pop(name)) for name in _stateNames
+                       if name in self.__dict__)
+            self.numBV = 0
+            self._allocate(max(self.maxBV + 1, old['BV'].shape[0]))
+            for name in _stateNames:
+                if name in old:
+                    setattr(self, name, old[name])
+
+            # models pickled before the Cholesky factor existed
+            if 'KBchol' not in old:
+                self.choleskyQ = True
+                if(self.numBV > 0):
+                    self.KBchol = np.linalg.cholesky(self.KB)
         
         # Should also manually recreate unpicklable members.
         # Example: file = load(self.filename)
+        self._kernels = {}
+        self._kxbuf = None
+
+        # models pickled before the kernel backends
+        if 'backend' not in state:
+            self.backend = 'numpy'
+            self.float32Q = False
 
-    def fit(self, X, Y, m=0):
+    def fit(self, X, Y, m=0, batchQ=False):
         X = np.array(X) # numpy and pandas have inconsistent slicing conventions so choose one
         # just train on all the data in X. m is a dummy parameter
+        if(batchQ and self.numBV == 0 and X.shape[0] > 0):
+            # empty model, build it from all the data at once, see batchFit
+            self.batchFit(X, Y)
+            return
         for i in range(X.shape[0]):
             self.update(np.array(X[i],ndmin=2),np.array([Y[i]]))
                 #self.update(x, Y[i])
 
+    def batchFit(self, X, Y):
+        # builds the model from N points at once, replacing its state. The
+        #   BVs are picked greedily by a pivoted Cholesky factorization of the
+        #   (N x N) Gram matrix, which only ever forms the columns of picked
+        #   BVs: each step takes the most novel remaining point (largest
+        #   gamma, as in update) until maxBV BVs are picked or no point is
+        #   novel anymore. All the data is then projected onto those BVs,
+        #   which is what the proj updates do one point at a time. O(N m^2)
+        #   for m BVs instead of N updates of O(m^2) plus a removal each.
+        #   The catch is accuracy: novelty alone spreads the BVs evenly over
+        #   the inputs, while the KL scores of update keep the BVs that matter
+        #   for the fit. With N much larger than maxBV the held-out error is
+        #   about 1.5 times that of updating row by row, e.g. 0.67 vs 0.42
+        #   RMSE for 2000 points and maxBV 100 (see benchmarkFit). With all
+        #   points as BVs the two agree
+
+        X = np.array(X, ndmin=2)
+        r = np.reshape(np.array(Y, dtype=float), (-1,1)) - self.priorMean(X)
+        N = X.shape[0]
+        maxBV = min(self.maxBV, N) if self.sparsityQ else N
+
+        # kernel values with BVs, the noise is on the diagonal of KB, see
+        #   update, so only a point with itself gets it
+        diag = self.computeCovDiag(X, is_self=True).ravel()
+        gamma = diag.copy()
+        Lx = np.zeros((N,maxBV)) # rows of the Cholesky factor, Lx Lx^T ~ K
+        picked = []
+        for j in range(maxBV):
+            p = gamma.argmax()
+            if(self.sparsityQ and gamma[p] < self.thresh*diag[p]):
+                break
+            col = self.computeCov(X, X[[p]]).ravel()
+            col[p] = diag[p]
+            col -= np.dot(Lx[:,:j], Lx[p,:j])
+            Lx[:,j] = col / np.sqrt(gamma[p])
+            gamma -= Lx[:,j] * Lx[:,j]
+            gamma[p] = -np.inf
+            picked += [p]
+        numBV = len(picked)
+        Lx = Lx[:,:numBV]
+        L = Lx[picked]
+
+        # projected posterior: with V = L^-1 K(BV,X) = Lx^T and
+        #   A = I + V V^T / noise, alpha = L^-T A^-1 V r / noise and
+        #   C = L^-T (A^-1 - I) L^-1
+        LA = np.linalg.cholesky(np.eye(numBV) + np.dot(Lx.transpose(), Lx) / self.noise_var)
+        Linv = solve_triangular(L, np.eye(numBV), lower=True)
+        Ainv = cho_solve((LA, True), np.eye(numBV))
+
+        self.numBV = 0
+        self.BV = X[picked]
+        self.KB = np.dot(L, L.transpose())
+        self.KBinv = np.dot(Linv.transpose(), Linv)
+        self.alpha = np.dot(Linv.transpose(),
+            cho_solve((LA, True), np.dot(Lx.transpose(), r))) / self.noise_var
+        self.C = np.dot(Linv.transpose(), np.dot(Ainv - np.eye(numBV), Linv))
+        if(self.choleskyQ):
+            self.KBchol = L
+
+        stabilizeMatrix(self.C, inplace=True)
+        stabilizeMatrix(self.KB, inplace=True)
+        stabilizeMatrix(self.KBinv, inplace=True)
+
     def update(self, x_new, y_new):
         # compute covariance with BVs
         k_x = self.computeCov(self.BV, x_new)
@@ -154,8 +352,11 @@ class OGP(object):
         (logLik, K1, K2) = logLikelihood(self.noise_var, y_new, cM+pM, cV)
 
         # compute gamma, a geometric measure of novelty
-        if(self.KB.shape[0] > 0):
-            hatE = solve(self.KB, k_x)
+        if(self.numBV > 0):
+            if(self.choleskyQ):
+                hatE = cho_solve((self.KBchol, True), k_x)
+            else:
+                hatE = solve(self.KB, k_x)
             gamma = k - np.dot(np.transpose(k_x),hatE)
         else:
             hatE = np.array([],ndmin=2).transpose()
@@ -173,7 +374,7 @@ class OGP(object):
         # reduce model according to maxBV constraint
         if self.sparsityQ:
             if self.verboseQ: print("OGP - INFO: Cutting BVs")
-            while(self.BV.shape[0] > self.maxBV):
+            while(self.numBV > self.maxBV):
                 minBVind = self.scoreBVs()
                 self.deleteBV(minBVind)
         else:
@@ -198,14 +399,111 @@ class OGP(object):
  #        print(('OGP: gpMean, gpVar = ',gpMean, gpVar))
 
         # combine with prior and return posterior PDF
-        if(isinstance(self.prmean, collections.Callable) and isinstance(self.prvar, collections.Callable)): # we have a prior mean & variance
+        return self._combinePrior(x_in, gpMean, gpVar)
+
+    def predictBatch(self, x_in):
+        # reads in a (n x dim) array and returns the (n x 1) vectors of
+        #   predictions and of marginal predictive variances, i.e. only the
+        #   diagonal of the predict covariance. Takes O(n m^2) time and
+        #   O(n m) memory for m BVs, so thousands of points fit in one call
+
+        x_in = np.array(x_in, ndmin=2)
+        k = self.computeCovDiag(x_in, is_self=True)
+
+        if(self.BV.shape[0] > 0):
+            k_x = self.computeCov(x_in, self.BV, out=self._workspace(x_in.shape[0]))
+            gpMean = np.dot(k_x, self.alpha)
+            # row-wise k_x C k_x^T without forming the (n x n) matrix
+            gpVar = k + np.einsum('ij,ij->i', np.dot(k_x, self.C), k_x)[:,None]
+        else:
+            gpMean = np.zeros((x_in.shape[0],1))
+            gpVar = k
+
+        return self._combinePrior(x_in, gpMean, gpVar)
+
+    def predictGrad(self, x_in):
+        # same as predictBatch, but also returns the (n x dim) gradients of
+        #   the mean and of the marginal variance with respect to each input.
+        #   For the RBF and CBF kernels dk(x,b)/dx = -k(x,b) P (x - b) where
+        #   P is the kernel precision matrix
+
+        x_in = np.array(x_in, ndmin=2)
+        (n, dim) = x_in.shape
+        k = self.computeCovDiag(x_in, is_self=True)
+
+        if(self.numBV > 0):
+            P = self.kernelPrecision()
+            k_x = self.computeCov(x_in, self.BV, out=self._workspace(n))
+            kC = np.dot(k_x, self.C)
+            gpMean = np.dot(k_x, self.alpha)
+            gpVar = k + np.einsum('ij,ij->i', kC, k_x)[:,None]
+
+            # sum_j w_ij (x_i - b_j) for the weights of the mean and variance
+            w = k_x * self.alpha.transpose()
+            dMean = -np.dot(w.sum(axis=1)[:,None] * x_in - np.dot(w, self.BV), P)
+            w = k_x * kC
+            dVar = -2 * np.dot(w.sum(axis=1)[:,None] * x_in - np.dot(w, self.BV), P)
+        else:
+            gpMean = np.zeros((n,1))
+            gpVar = k
+            dMean = np.zeros((n,dim))
+            dVar = np.zeros((n,dim))
+
+        # combine with the prior, whose gradients are taken numerically
+        #   since the prior functions are arbitrary callables
+        if(callable(self.prmean)):
+            priorMean = self.priorMean(x_in)
+            dPriorMean = self._numericalGrad(self.priorMean, x_in)
+            if(callable(self.prvar)):
+                priorVar = self.priorVar(x_in)
+                dPriorVar = self._numericalGrad(self.priorVar, x_in)
+                norm = gpVar + priorVar
+                dNorm = dVar + dPriorVar
+                postMean = (priorMean * gpVar + gpMean * priorVar) / norm
+                postVar = gpVar * priorVar / norm
+                dMean = (dPriorMean * gpVar + priorMean * dVar + dMean * priorVar
+                         + gpMean * dPriorVar - postMean * dNorm) / norm
+                dVar = (dVar * priorVar + gpVar * dPriorVar - postVar * dNorm) / norm
+                return postMean, postVar, dMean, dVar
+            else:
+                return gpMean + priorMean, gpVar, dMean + dPriorMean, dVar
+        else:
+            return gpMean, gpVar, dMean, dVar
+
+    def _workspace(self, n):
+        # (n x numBV) scratch array for kernel values, reused between calls
+        dtype = np.float32 if self.float32Q else np.float64
+        size = n * self.numBV
+        if(self._kxbuf is None or self._kxbuf.size < size or self._kxbuf.dtype != dtype):
+            self._kxbuf = np.empty(size, dtype=dtype)
+        return self._kxbuf[:size].reshape((n,self.numBV))
+
+    def _numericalGrad(self, f, x_in, h=1.e-6):
+        # forward difference (n x dim) gradient of a function returning (n x 1)
+        (n, dim) = x_in.shape
+        f0 = np.reshape(f(x_in), (-1,1))
+        grad = np.zeros((n,dim))
+        for d in range(dim):
+            x_h = x_in.copy()
+            x_h[:,d] += h
+            grad[:,[d]] = (np.reshape(f(x_h), (-1,1)) - f0) / h
+        return grad
+
+    def kernelPrecision(self):
+        # the (dim x dim) matrix P such that the covariance function is
+        #   coeff * exp(-(x1 - x2)^T P (x1 - x2) / 2), see computeCBF
+
+        return self.getKernel().precision
+
+    def _combinePrior(self, x_in, gpMean, gpVar):
+        if(callable(self.prmean) and callable(self.prvar)): # we have a prior mean & variance
             priorMean = self.priorMean(x_in)
             priorVar = self.priorVar(x_in)
             # posterior
             postMean = (priorMean * gpVar + gpMean * priorVar) / (gpVar + priorVar)
             postVar = gpVar * priorVar / (gpVar + priorVar)
             return postMean, postVar
-        elif(isinstance(self.prmean, collections.Callable)): # we have a prior mean
+        elif(callable(self.prmean)): # we have a prior mean
             priorMean = self.priorMean(x_in)
             return gpMean + priorMean, gpVar
         else: # no prior
@@ -219,51 +517,65 @@ class OGP(object):
             eta += K2 * gamma
 
         CplusQk = np.dot(self.C, k_x) + hatE
-        self.alpha = self.alpha + (K1 / eta) * CplusQk
+        alpha = self.alpha
+        alpha += (K1 / eta) * CplusQk
         eta = K2 / eta
-        self.C = self.C + eta * np.dot(CplusQk,CplusQk.transpose())
-        self.C = stabilizeMatrix(self.C)
+        C = self.C
+        C += eta * np.dot(CplusQk,CplusQk.transpose())
+        stabilizeMatrix(C, inplace=True)
 
     def _fullParamUpdate(self, x_new, k_x, k, K1, K2, gamma, hatE):
-        # expands parameters to incorporate new input
+        # expands parameters to incorporate new input, the new BV goes
+        #   into the next free row/column of the buffers
 
-        # add new input to basis vectors
-        oldnumBV = self.BV.shape[0]
+        oldnumBV = self.numBV
         numBV = oldnumBV + 1
-        
-        if(self.BV.shape == (0,)): # seems like self.BV and x_new have incompatible shapes for first call
-            self.BV = x_new
-        else:
-            self.BV = np.concatenate((self.BV,x_new), axis=0)
-            
+
+        Ck = extendVector(np.dot(self.C, k_x), val=1)
         hatE = extendVector(hatE, val=-1)
-        
+
+        self._reserve(numBV)
+        self.numBV = numBV
+
+        # the buffers may still hold values of removed BVs
+        self._BVbuf[oldnumBV] = x_new
+        self._alphabuf[oldnumBV] = 0
+        for M in [self._Cbuf, self._KBbuf, self._KBinvbuf, self._KBcholbuf]:
+            M[oldnumBV,:numBV] = 0
+            M[:numBV,oldnumBV] = 0
+
         # update KBinv
-        self.KBinv = extendMatrix(self.KBinv)
-        self.KBinv = self.KBinv + (1 / gamma) * np.dot(hatE,hatE.transpose())
-        
+        KBinv = self.KBinv
+        KBinv += (1 / gamma) * np.dot(hatE,hatE.transpose())
+
         # update Gram matrix
-        self.KB = extendMatrix(self.KB)
+        KB = self.KB
         if(numBV > 1):
-            self.KB[0:oldnumBV,[oldnumBV]] = k_x
-            self.KB[[oldnumBV],0:oldnumBV] = k_x.transpose()
-        self.KB[oldnumBV,oldnumBV] = k
-        
-        Ck = extendVector(np.dot(self.C, k_x), val=1)
-        
-        self.alpha = extendVector(self.alpha)
-        self.C = extendMatrix(self.C)
-        self.alpha = self.alpha + K1 * Ck
-        self.C = self.C + K2 * np.dot(Ck, Ck.transpose())
+            KB[0:oldnumBV,[oldnumBV]] = k_x
+            KB[[oldnumBV],0:oldnumBV] = k_x.transpose()
+        KB[oldnumBV,oldnumBV] = np.asarray(k).item()
+
+        # extend the Cholesky factor with the new row, whose last entry is
+        #   sqrt(gamma) since gamma = k - k_x^T KB^-1 k_x
+        if(self.choleskyQ):
+            L = self.KBchol
+            if(numBV > 1):
+                l = solve_triangular(L[:oldnumBV,:oldnumBV], k_x, lower=True)
+                L[[oldnumBV],0:oldnumBV] = l.transpose()
+            L[oldnumBV,oldnumBV] = np.sqrt(np.maximum(gamma, 1.e-12)).item()
+
+        alpha = self.alpha
+        alpha += K1 * Ck
+        C = self.C
+        C += K2 * np.dot(Ck, Ck.transpose())
 
         # stabilize matrices for conditioning/reducing floating point errors?
-        self.C = stabilizeMatrix(self.C)
-        self.KB = stabilizeMatrix(self.KB)
-        self.KBinv = stabilizeMatrix(self.KBinv)
+        stabilizeMatrix(C, inplace=True)
+        stabilizeMatrix(KB, inplace=True)
+        stabilizeMatrix(KBinv, inplace=True)
 
     def scoreBVs(self):
         # measures the importance of each BV for model accuracy
-        # currently quite slow for the weighted GP if numBV is much more than 50
 
         numBV = self.BV.shape[0]
         a = self.alpha
@@ -271,18 +583,50 @@ class OGP(object):
             scores = ((a * a).reshape((numBV)) /
                 (self.C.diagonal() + self.KBinv.diagonal()))
         else:
-            scores = np.zeros(shape=(numBV,1))
+            scores = self.weightedScores()
 
-            # This is slow, in particular the numBV calls to computeWeightedDiv
-            for removed in range(numBV):
-                (hatalpha, hatC) = self.getUpdatedParams(removed)
+        return scores.argmin()
 
-                scores[removed] = self.computeWeightedDiv(hatalpha, hatC, removed)
+    def weightedScores(self):
+        # weighted divergences of removing each BV, i.e. what
+        #   computeWeightedDiv(*getUpdatedParams(i), i) gives for every i, in
+        #   one pass. Removing BV i turns V = C + KBinv into a rank-two update
+        #   of itself, so Woodbury and the matrix determinant lemma reduce all
+        #   the hatV solves and determinants to W = inv(V), P = W KBinv and
+        #   a few of their diagonals: O(m^3) overall instead of O(m^4)
 
-        return scores.argmin()
+        a = self.alpha
+        KBinv = self.KBinv
+        V = self.C + KBinv
+        W = inv(V)
+        P = np.dot(W, KBinv)
+
+        # Gamma a and the part of M and diff that does not depend on i
+        Ka = np.dot(self.KB, a)
+        g = a + (a + np.dot(self.C, Ka)) / np.dot(a.transpose(), Ka)
+        h = g - a
+        hWh = np.dot(h.transpose(), np.dot(W, h)).item()
+        g = g.ravel()
+        h = h.ravel()
+
+        q = KBinv.diagonal()
+        v = V.diagonal()
+        r = np.einsum('ki,ki->i', KBinv, P)  # diag(KBinv W KBinv)
+        t = np.dot(P.transpose(), h)
+
+        scores = (g * g / q - hWh -
+            ((q + r) * h * h - 2 * q * h * t) / (q * q))
+
+        # trace and log-determinant terms, det(V hatV) = v / q
+        ratio = v / q
+        valid = ratio > 0
+        w = np.full(ratio.shape, np.inf)
+        w[valid] = ((q + r) * v / (q * q) - 2)[valid] - np.log(ratio[valid])
+
+        return (scores + w).reshape((-1,1))
 
     def priorMean(self, x):
-        if(isinstance(self.prmean, collections.Callable)):
+        if(callable(self.prmean)):
             if(self.prmeanp is not None):
                 return self.prmean(x, self.prmeanp)
             else:
@@ -294,7 +638,7 @@ class OGP(object):
             return 0
 
     def priorVar(self, x):
-        if(isinstance(self.prvar, collections.Callable)):
+        if(callable(self.prvar)):
             if(self.prvarp is not None):
                 return self.prvar(x, self.prvarp)
             else:
@@ -309,24 +653,31 @@ class OGP(object):
         # removes a BV from the model and modifies parameters to
         #   attempt to minimize the removal's impact
 
-        numBV = self.BV.shape[0]
-        keepInd = [i for i in range(numBV) if i != removeInd]
+        # updated alpha and C
+        (hatalpha, hatC) = self.getUpdatedParams(removeInd)
 
-        # update alpha and C
-        (self.alpha, self.C) = self.getUpdatedParams(removeInd)
+        # KBinv column and Cholesky column of the removed BV
+        q_star = self.KBinv[removeInd,removeInd]
+        red_q = np.delete(self.KBinv[:,[removeInd]], removeInd, axis=0)
+        if(self.choleskyQ):
+            l = self.KBchol[removeInd+1:,removeInd].copy()
 
-        # stabilize C
-        self.C = stabilizeMatrix(self.C)
+        self._compact(removeInd)
 
-        # update KB and KBinv
-        q_star = self.KBinv[removeInd,removeInd]
-        red_q = self.KBinv[keepInd][:,[removeInd]]
-        self.KBinv = (self.KBinv[keepInd][:,keepInd] -
-            (1 / q_star) * np.dot(red_q, red_q.transpose()))
-        self.KBinv = stabilizeMatrix(self.KBinv)
+        self.alpha[:] = hatalpha
+        C = self.C
+        C[:] = hatC
+        stabilizeMatrix(C, inplace=True)
 
-        self.KB = self.KB[keepInd][:,keepInd]
-        self.BV = self.BV[keepInd]
+        # update KBinv, KB has just lost its row and column
+        KBinv = self.KBinv
+        KBinv -= (1 / q_star) * np.dot(red_q, red_q.transpose())
+        stabilizeMatrix(KBinv, inplace=True)
+
+        # removing a row/column of KB is a rank-one update of the trailing
+        #   block of its Cholesky factor
+        if(self.choleskyQ):
+            cholUpdate(self.KBchol[removeInd:,removeInd:], l)
 
     def computeWeightedDiv(self, hatalpha, hatC, removeInd):
         # computes the weighted divergence for removing a specific BV
@@ -403,120 +754,69 @@ class OGP(object):
 
         return hatalpha, hatC
 
-    def computeCov(self, x1, x2, is_self=False):
+    def computeCov(self, x1, x2, is_self=False, out=None):
         # computes covariance between inputs x1 and x2
-        #   returns a matrix of size (n1 x n2)
+        #   returns a matrix of size (n1 x n2), written into out if given
+        #   (in the precision of out)
         
         if np.size(np.shape(self.covar_params[0])) == 2:
-            K = self.computeCBF(x1, x2)
+            K = self.computeCBF(x1, x2, out=out)
         else:
-            K = self.computeRBF(x1, x2)
-        if(is_self):
-            K = K + self.noise_var * np.eye(x1.shape[0])
+            K = self.computeRBF(x1, x2, out=out)
+        if(is_self and K.size):
+            K.flat[::K.shape[1]+1] += self.noise_var
             
         return K
 
-    def computeRBF(self, x1, x2): # radial basis functions
-        (n1, dim) = x1.shape
-        n2 = x2.shape[0]
-
-        (hyp_ARD, hyp_coeff) = self.covar_params
-
-        # turn to normal units
-        b = np.exp(hyp_ARD)
-        coeff = np.exp(hyp_coeff)
-
-        # use ARD to scale
-        b_sqrt = np.sqrt(b)
-        x1 = x1 * b_sqrt
-        x2 = x2 * b_sqrt
-
-        x1_sum_sq = np.reshape(np.sum(x1 * x1, axis=1), (n1,1))
-        x2_sum_sq = np.reshape(np.sum(x2 * x2, axis=1), (1,n2))
-
-        K = -2 * np.dot(x1, x2.transpose())
-        K = K + x1_sum_sq + x2_sum_sq
-        K = coeff * np.exp(-0.5 * K)
+    def computeCovDiag(self, x, is_self=False):
+        # diagonal of computeCov(x, x, is_self) as a (n x 1) vector; all
+        #   the supported kernels equal the amplitude at zero distance
 
-        return K
+        coeff = np.exp(self.covar_params[1])
+        if(is_self):
+            coeff = coeff + self.noise_var
+
+        return np.full((x.shape[0],1), coeff)
+
+    def getKernel(self, kind='RBF', nu=2.5, dtype=np.float64):
+        # the Kernel object of the current hyperparameters, which is only
+        #   rebuilt when they (or the backend) change
+
+        hyps = (np.shape(self.covar_params[0]),
+                np.asarray(self.covar_params[0], dtype=float).tobytes(),
+                float(self.covar_params[1]),
+                None if self.precisionMatrix is None else
+                np.asarray(self.precisionMatrix, dtype=float).tobytes(),
+                self.backend)
+        key = (kind, nu, np.dtype(dtype).str)
+        kernel = self._kernels.get(key)
+        if(kernel is None or kernel.hyps != hyps):
+            kernel = Kernel(self.covar_params[0], self.covar_params[1],
+                            precisionMatrix=self.precisionMatrix, kind=kind,
+                            nu=nu, dtype=dtype, backend=self.backend)
+            kernel.hyps = hyps
+            self._kernels[key] = kernel
+        return kernel
+
+    def computeRBF(self, x1, x2, out=None): # radial basis functions
+        dtype = np.float64 if out is None else out.dtype
+        return self.getKernel(dtype=dtype)(x1, x2, out=out)
 
     # updated to allow non-diagonal kernel matrix
-    def computeCBF(self, x1, x2): # correlated basis functions
+    def computeCBF(self, x1, x2, out=None): # correlated basis functions
         (n1, dim) = x1.shape
         n2 = x2.shape[0]
 
         if n1*n2 == 0:
             return np.array([])
 
-        (hyp_ARD, hyp_coeff) = self.covar_params
-        coeff = np.exp(hyp_coeff)
-
-        if type(self.precisionMatrix) == type(None):
-
-            # turn to normal units
-            b = np.exp(hyp_ARD)
-
-            # if kernel params are a vector, reshape to a diagonal matrix
-            sk = np.shape(b)
-            nk = np.size(sk) # 0 if scalar; 1 if vector; 2 if matrix
-            if nk < 2:
-                b = np.diagflat(b)
-            elif nk == 2 and sk[0] < sk[1]:
-                b = np.diagflat(b)
-            elif nk > 2:
-                print('WARNING - OnlineGP: kernel is a strange shape.')
-
-        else:
-            b = self.precisionMatrix
-
-        # save duplicate computations
-        bdotx1T = np.array([np.dot(b,x.transpose()).transpose() for x in x1])
-        bdotx2T = np.array([np.dot(b,x.transpose()).transpose() for x in x2])
-
-        x1_sum_sq = np.reshape(np.sum(x1 * bdotx1T, axis=1), (n1,1))
-        x2_sum_sq = np.reshape(np.sum(x2 * bdotx2T, axis=1), (1,n2))
+        # same kernel as RBF, with precisionMatrix if given
+        dtype = np.float64 if out is None else out.dtype
+        return self.getKernel(dtype=dtype)(x1, x2, out=out)
 
-        K = -2 * np.dot(x1, bdotx2T.transpose())
-        K = K + x1_sum_sq + x2_sum_sq
-        K = coeff * np.exp(-0.5 * K)
-
-        return K
-
-    def computeMatern(self, x1, x2, nu=2.5):
-        (n1, dim) = x1.shape
-        n2 = x2.shape[0]
-
-        (hyp_ARD, hyp_coeff) = self.covar_params
-
-        b = np.exp(hyp_ARD)
-        coeff = np.exp(hyp_coeff)
-
-        # use ARD to scale
-        b_sqrt = np.sqrt(b)
-        x1 = x1 * b_sqrt
-        x2 = x2 * b_sqrt
-
-        if(n1 != n2 or np.any(x1-x2)):
-            x1_sum_sq = np.reshape(np.sum(x1 * x1, axis=1), (n1,1))
-            x2_sum_sq = np.reshape(np.sum(x2 * x2, axis=1), (1,n2))
-
-            dist_sq = -2 * np.dot(x1, x2.transpose())
-            dist_sq = dist_sq + x1_sum_sq + x2_sum_sq
-            dist = np.sqrt(dist_sq)
-        else:
-            dist = np.zeros((n1,n2))
-            dist_sq = np.zeros((n1,n2))
-
-        if(nu==1.5):
-            poly = 1 + np.sqrt(3.0)*dist
-        elif(nu==2.5):
-            poly = 1 + np.sqrt(5.0)*dist + (5.0/3.0)*dist_sq
-        else:
-            print('ERROR - OnlineGP: Invalid nu (only 1.5 and 2.5 supported)')
-
-        K = coeff * poly * np.exp(-np.sqrt(2*nu)*dist)
-
-        return K
+    def computeMatern(self, x1, x2, nu=2.5, out=None):
+        dtype = np.float64 if out is None else out.dtype
+        return self.getKernel(kind='Matern', nu=nu, dtype=dtype)(x1, x2, out=out)
         
     # end OGP class
 
@@ -530,7 +830,11 @@ def logLikelihood(noise, y, mu, var):
 
     return logLik, K1, K2
 
-def stabilizeMatrix(M):
+def stabilizeMatrix(M, inplace=False):
+    if(inplace):
+        M += M.transpose()
+        M *= 0.5
+        return M
     return (M + M.transpose()) / 2
 
 def extendMatrix(M, ind=-1):
@@ -554,3 +858,25 @@ def extendVector(v, val=0, ind=-1):
         return np.concatenate(([[val]],v),axis=0)
     else:
         return np.concatenate((v[:ind],[[val]],v[ind:]),axis=0)
+
+def cholUpdate(L, x):
+    # in-place rank-one update of the lower Cholesky factor L of A so that
+    #   L L^T = A + x x^T afterwards, in O(m^2). With p = L^-1 x this is
+    #   L T where T T^T = I + p p^T, whose factor has the closed form
+    #   T_jj = d_j, T_ij = p_i beta_j (i > j), so the product needs no loop
+    #   over the columns of L
+    if(L.size == 0):
+        return L
+    p = solve_triangular(L, np.ravel(x), lower=True)
+    p2 = p * p
+    a = 1 + np.cumsum(p2) - p2
+    d = np.sqrt(1 + p2 / a)
+    beta = p / (a * d)
+
+    # column j of L T is d_j L[:,j] + beta_j sum_{i>j} p_i L[:,i]
+    M = L * p
+    S = np.zeros_like(M)
+    S[:,:-1] = np.cumsum(M[:,:0:-1], axis=1)[:,::-1]
+    L *= d
+    L += S * beta
+    return L
@@ -31,11 +31,17 @@ Initialization parameters:
         since the model can be trained externally as well.
         Assumed to be a pandas DataFrame of shape (n, dim+1) where the last
             column contains y-values.
+    batchFitQ: whether to fit prior_data all at once with the model's
+        batchFit instead of row by row. Much faster for a lot of prior data,
+        but the BVs are picked by novelty only, which gives about 1.5 times
+        the held-out error (see OGP.batchFit).
 Methods:
     acquire(): Returns the point that maximizes the acquisition function.
         For 'testEI', returns the index of the point instead.
         For normal acquisition, currently uses the bounded L-BFGS optimizer.
             Haven't tested alternatives much.
+        With acq_mode == 'candidates', scores a large candidate pool at once
+            and only refines the best few, within time_budget seconds.
     best_seen(): Uses the model to make predictions at every observed point,
         returning the best-performing (x,y) pair. This is more robust to noise
         than returning the best observation, but could be replaced by other,
@@ -43,6 +49,15 @@ Methods:
     OptIter(): The main method for Bayesian optimization. Maximizes the
         acquisition function, then uses the interface to test this point and
         update the model.
+    OptIterPipelined(): Same as OptIter, but overlaps the acquisition of
+        the next point with the evaluation of this one. The acquisition runs
+        on a model which assumes the predicted mean will be measured; once
+        the real value is in, the prepared candidates are re-ranked. Used by
+        OptIter when pipelineQ is True.
+    close(): Stops the worker processes used for the acquisition. Call when
+        done optimizing.
+    lengthCache(): The length scales of the model and the search box sizes
+        derived from them, cached until the hyperparameters change.
 
 # TODO callbacks or real-time acquisition needed: appears that the minimizer for the acquisition fcn only looks for number of devices when loaded; not when devices change
 2018-04-24: Need to improve hyperparam import
@@ -55,9 +70,12 @@ Methods:
 """
 
 import os # check os name
+import time
+import logging
 import operator as op
 import numpy as np
 from scipy.stats import norm
+from scipy.special import erfinv
 from scipy.optimize import minimize
 from scipy.optimize import approx_fprime
 try:
@@ -73,7 +91,10 @@ except:
     print ('failed to import parallelstuff')
     basinhoppingQ = False
     multiprocessingQ = False
+import copy
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor, wait
+from .chaospy_sequences import SobolGenerator, HaltonGenerator, DIM_MAX
 
 
 def normVector(nparray):
@@ -81,7 +102,7 @@ def normVector(nparray):
 
 
 class BayesOpt:
-    def __init__(self, model, evaluate, acq_func='EI', xi=0.0, alt_param=-1, m=200, bounds=None, iter_bound=False, prior_data=None, start_dev_vals=None, searchBoundScaleFactor=None):
+    def __init__(self, model, evaluate, acq_func='EI', xi=0.0, alt_param=-1, m=200, bounds=None, iter_bound=False, prior_data=None, start_dev_vals=None, searchBoundScaleFactor=None, batchFitQ=False):
         self.model = model
         self.m = m
         self.bounds = bounds
@@ -93,6 +114,7 @@ class BayesOpt:
                 print(('BayesOpt - ERROR: ', searchBoundScaleFactor, ' is not a valid searchBoundScaleFactor (scaling coeff).'))
         self.iter_bound = iter_bound
         self.prior_data = prior_data # for seeding the GP with data acquired by another optimizer
+        self.batchFitQ = batchFitQ # fit prior_data all at once, see OGP.batchFit
         self.evaluate= evaluate
         print('target_func = ', evaluate)
         self.acq_func = (acq_func, xi, alt_param)
@@ -111,6 +133,19 @@ class BayesOpt:
         self.kill = False
         self.ndim = np.array(start_dev_vals).size
         self.multiprocessingQ = multiprocessingQ # speed up acquisition function optimization
+        self.pool = WorkerPool() if multiprocessingQ else None # worker processes, kept for the whole run
+        self.acq_mode = 'grid' # 'grid': grid searches + local searches, 'candidates': see acquireCandidates
+        self.ncandidates = 2048 # size of the candidate pool for acq_mode 'candidates'
+        self.nrefine = 4 # number of best candidates refined by local search
+        self.time_budget = None # seconds per acquisition, None for no limit
+        self.acq_times = [] # how long each acquisition took, in seconds
+        self.candidates = None # low-discrepancy sequence of the candidate pools
+        self.pipelineQ = False # acquire the next point while the machine settles, see OptIterPipelined
+        self.prepared = None # candidates for the next point in pipelined mode
+        self.last_candidates = None # best points looked at by the last acquisition
+        self.executor = None # background thread for pipelined mode
+        self.nfantasy = 0 # number of made-up observations at the end of X_obs/Y_obs, see fantasize
+        self.length_cache = (None, None) # (hyperparameter hash, lengths), see lengthCache
 
         #Post-edit
         self.start_dev_vals = start_dev_vals
@@ -129,19 +164,12 @@ class BayesOpt:
             print('BayesOpt - ERROR: Could not grab initial machine state')
 
         # calculate length scales
-        try:
-            # length scales from covar params
-            cp = self.model.covar_params[0]
-            cps = np.shape(cp)
-            lengthscales = np.sqrt(1./np.exp(cp))
-            if np.size(cps) == 2:
-                if cps[0] < cps[1]: # vector of lengths
-                    self.lengthscales = lengthscales.flatten()
-                else: # matrix of lengths
-                    self.lengthscales = np.diag(lengthscales)
-        except:
-            print('WARNING - GP.bayesian_optimization.BayesOpt: Using some unit length scales cause we messed up somehow...')
-            self.lengthscales = np.ones(len(start_dev_vals))
+        self.lengthCache()
+
+        # seed the model with the prior data
+        if self.prior_data is not None:
+            prior_data = np.array(self.prior_data, ndmin=2)
+            self.model.fit(prior_data[:,:-1], prior_data[:,-1], batchQ=self.batchFitQ)
 
         ## initialize the prior
         #self.model.prmean = None # prior mean fcn
@@ -153,9 +181,47 @@ class BayesOpt:
         print('Using prior mean function of ', self.model.prmean)
         print('Using prior mean parameters of ', self.model.prmeanp)
 
+    @property
+    def lengthscales(self):
+        return self.lengthCache()['lengthscales']
+
+    def lengthCache(self):
+        # length scales of the model and the search box sizes derived from
+        #   them, recomputed only when the hyperparameters (or the search
+        #   scale factor) change, e.g. after loading another scan_params file
+        cp = np.asarray(self.model.covar_params[0], dtype=float)
+        key = hash((cp.shape, cp.tobytes(), self.searchBoundScaleFactor))
+        if self.length_cache[0] == key:
+            return self.length_cache[1]
+
+        try:
+            # length scales from covar params
+            cps = np.shape(cp)
+            lengthscales = np.sqrt(1./np.exp(cp))
+            if np.size(cps) == 2 and cps[0] >= cps[1]: # matrix of lengths
+                lengthscales = np.diag(lengthscales)
+            else: # vector of lengths
+                lengthscales = lengthscales.flatten()
+        except:
+            print('WARNING - GP.bayesian_optimization.BayesOpt: Using some unit length scales cause we messed up somehow...')
+            lengthscales = np.ones(self.ndim)
+
+        bound_lengths = self.searchBoundScaleFactor * 3. * lengthscales # 3x hyperparam lengths
+        cache = {
+            'lengthscales': lengthscales,
+            'grid_lengths': self.searchBoundScaleFactor * 0.6 * lengthscales, # widths of the searches around points
+            'bound_lengths': bound_lengths,
+            'relative_bounds': np.transpose(np.array([-bound_lengths, bound_lengths])),
+        }
+        self.length_cache = (key, cache)
+        return cache
+
     def OptIter(self,pause=0):
         # runs the optimizer for one iteration
 
+        if(self.pipelineQ and self.acq_func[0] != 'testEI'):
+            return self.OptIterPipelined()
+
         # get next point to try using acquisition function
         x_next = self.acquire()
         if(self.acq_func[0] == 'testEI'):
@@ -171,6 +237,122 @@ class BayesOpt:
         # update the model (may want to add noise if using testEI)
         self.model.update(x_new, y_new)# + .5*np.random.randn())
 
+    def OptIterPipelined(self):
+        # runs the optimizer for one iteration, preparing the next one while
+        #   the machine moves to this one and settles
+
+        # the next point is the best of the candidates prepared during the
+        #   last evaluation, re-ranked by the model that now knows its result
+        if(self.prepared is None):
+            x_next = self.acquire()
+        else:
+            x_next = self.rerank(self.prepared)
+            self.prepared = None
+
+        # speculative acquisition for the next iteration, in the background
+        #   on a copy of the optimizer whose model believes it will measure
+        #   the predicted mean at x_next
+        fantasy = self.fantasize(x_next)
+        if(self.executor is None):
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        speculation = self.executor.submit(fantasy.acquire)
+
+        try:
+            y_new, _, _, x_new = self.evaluate(x_next)
+        finally:
+            # nothing else may use the worker pool or the model meanwhile
+            wait([speculation])
+
+        try:
+            speculation.result()
+            self.prepared = fantasy.last_candidates
+        except Exception as e:
+            logging.warning(f'BayesOpt: speculative acquisition failed: {e}')
+
+        # add new entry to observed data
+        self.X_obs = np.concatenate((self.X_obs,x_new),axis=0)
+        self.Y_obs.append(y_new)
+
+        # update the model
+        self.model.update(x_new, y_new)
+
+    def fantasize(self, x_next):
+        # copy of the optimizer whose model has "observed" the predicted mean
+        #   at x_next. The made-up observation only shapes the model: the
+        #   best point and the search centres stay on the real observations
+        fantasy = copy.copy(self)
+        fantasy.model = deepcopy(self.model)
+        (y_mean, y_var) = fantasy.model.predictBatch(x_next)
+        fantasy.model.update(x_next, y_mean)
+        fantasy.X_obs = np.concatenate((self.X_obs,x_next),axis=0)
+        fantasy.Y_obs = self.Y_obs + [y_mean]
+        fantasy.nfantasy = self.nfantasy + 1
+        fantasy.acq_times = [] # speculative acquisitions aren't real ones
+        return fantasy
+
+    def rerank(self, candidates, alpha=1.):
+        # the best of the candidates by the acquisition function with the
+        #   current model, in a single batched evaluation. The candidates
+        #   were searched around the best point of the fantasy, so they are
+        #   brought back within the per-iteration bounds around the real one
+        (x_best, y_best) = self.best_seen()
+        bound_lengths = self.lengthCache()['bound_lengths']
+        candidates = np.clip(candidates, x_best - bound_lengths, x_best + bound_lengths)
+        (aqfcn, fargs) = self.acqFunction(y_best, self.X_obs.shape[1], 1 + self.X_obs.shape[0], alpha)
+        scores = aqfcn(candidates, *fargs).ravel()
+        return np.array(candidates[scores.argmin()], ndmin=2)
+
+    def close(self):
+        # stops the worker processes
+        if self.pool is not None:
+            self.pool.close()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def acquireCandidates(self, aqfcn, fargs, x_start, bounds, tolerance=1.e-4, deadline=None):
+        """
+        Scores a quasi-random pool of ncandidates points around x_start with
+        one batched prediction, then refines the nrefine best ones by
+        gradient based local search, one after the other until the deadline.
+        Like the grid search, the pool is normally distributed with widths
+        given by the length scales, and it continues a Sobol sequence so each
+        acquisition looks at new points. Returns the best point and the
+        best candidates with their refinements.
+        """
+        ndim = x_start.size
+        if(self.candidates is None or self.candidates.dim != ndim):
+            if(ndim < DIM_MAX):
+                self.candidates = SobolGenerator(ndim)
+            else:
+                self.candidates = HaltonGenerator(ndim)
+
+        lengths = self.lengthCache()['grid_lengths']
+        xs = np.sqrt(2) * erfinv(-1 + 2 * self.candidates.next(self.ncandidates).T) # normal in all dimensions
+        xs = np.clip(x_start + lengths * xs, bounds[:,0], bounds[:,1])
+        xs = np.vstack((x_start, xs))
+        scores = aqfcn(xs, *fargs).ravel()
+
+        ntop = min(self.nrefine, len(scores))
+        top = np.argpartition(scores, ntop - 1)[:ntop]
+        top = top[scores[top].argsort()]
+        (x_best, v_best) = (xs[top[0]], scores[top[0]])
+
+        refined = []
+        f = aqfcn if deadline is None else DeadlineObjective(aqfcn, deadline)
+        for i in top:
+            try:
+                res = minimize(f, xs[i], args=fargs+(True,), jac=True, method='L-BFGS-B', tol=tolerance, bounds=bounds, options={'maxiter':100})
+            except DeadlineReached:
+                if(f.fbest < v_best):
+                    (x_best, v_best) = (f.xbest, f.fbest)
+                break
+            refined += [res.x]
+            if(res.fun < v_best):
+                (x_best, v_best) = (res.x, res.fun)
+
+        return x_best, np.vstack([xs[top]] + refined)
+
     def best_seen(self):
         """
         Checks the observed points to see which is predicted to be best.
@@ -181,11 +363,12 @@ class BayesOpt:
 
         Not needed for UCB so do it the fast way (return max obs)
         """
+        # only the real observations, not the ones made up by fantasize
+        nobs = len(self.Y_obs) - self.nfantasy
         if(self.acq_func[0] == 'UCB'):
-            mu = self.Y_obs
+            mu = self.Y_obs[:nobs]
         else:
-            (mu, var) = self.model.predict(self.X_obs)
-            mu = [self.model.predict(np.array(x,ndmin=2))[0] for x in self.X_obs]
+            (mu, var) = self.model.predictBatch(self.X_obs[:nobs])
 
         (ind_best, mu_best) = max(enumerate(mu), key=op.itemgetter(1))
         return (self.X_obs[ind_best], mu_best)
@@ -194,8 +377,45 @@ class BayesOpt:
         """
         Computes the next point for the optimizer to try by maximizing
         the acquisition function. If movement per iteration is bounded,
-        starts search at current position.
+        starts search at current position. With a time_budget, returns the
+        best point found when the time is up, cancelling the searches still
+        running.
         """
+        t0 = time.time()
+        deadline = None if self.time_budget is None else t0 + self.time_budget
+
+        res = self._acquire(alpha, deadline)
+
+        dt = time.time() - t0
+        self.acq_times.append(dt)
+        if self.time_budget is None:
+            logging.info(f'BayesOpt: acquisition took {dt:.3f} s')
+        else:
+            logging.info(f'BayesOpt: acquisition took {dt:.3f} s of {self.time_budget} s budget')
+
+        return res
+
+    def acqFunction(self, y_best, ndim, nsteps, alpha=1.):
+        # the acquisition function to minimize and its arguments
+
+        # probability of improvement acquisition function
+        if(self.acq_func[0] == 'PI'):
+            aqfcn = negProbImprove
+            fargs=(self.model, y_best, self.acq_func[1])
+
+        # expected improvement acquisition function
+        elif(self.acq_func[0] == 'EI'):
+            aqfcn = negExpImprove
+            fargs = (self.model, y_best, self.acq_func[1], alpha)
+
+        # gaussian process upper confidence bound acquisition function
+        elif(self.acq_func[0] == 'UCB'):
+            aqfcn = negUCB
+            fargs = (self.model, ndim, nsteps, self.ucb_params[0], self.ucb_params[1])
+
+        return aqfcn, fargs
+
+    def _acquire(self, alpha, deadline):
         # look from best positions
         (x_best, y_best) = self.best_seen()
         self.x_best = x_best
@@ -213,8 +433,9 @@ class BayesOpt:
             if(self.bounds is None): # looks like a scale factor
                 self.bounds = 1.0
 
-            bound_lengths = self.searchBoundScaleFactor * 3. * self.lengthscales # 3x hyperparam lengths
-            relative_bounds = np.transpose(np.array([-bound_lengths, bound_lengths]))
+            lengths = self.lengthCache()
+            bound_lengths = lengths['bound_lengths'] # 3x hyperparam lengths
+            relative_bounds = lengths['relative_bounds']
 
             #iter_bounds = np.transpose(np.array([x_start - bound_lengths, x_start + bound_lengths]))
             iter_bounds = np.transpose(np.array([x_start - bound_lengths, x_start + bound_lengths]))
@@ -223,6 +444,8 @@ class BayesOpt:
             iter_bounds = self.bounds
 
         # options for finding the peak of the acquisition function:
+        # the acquisition functions return their analytic gradient when
+        # called with a trailing True argument, see jac=True below
         optmethod = 'L-BFGS-B' # L-BFGS-B, BFGS, TNC, and SLSQP allow bounds whereas Powell and COBYLA don't
         maxiter = 1000 # max number of steps for one scipy.optimize.minimize call
         try:
@@ -236,20 +459,10 @@ class BayesOpt:
         # perturb start to break symmetry?
         #x_start += np.random.randn(lengthscales.size)*lengthscales*1e-6
 
-        # probability of improvement acquisition function
-        if(self.acq_func[0] == 'PI'):
-            aqfcn = negProbImprove
-            fargs=(self.model, y_best, self.acq_func[1])
-
-        # expected improvement acquisition function
-        elif(self.acq_func[0] == 'EI'):
-            aqfcn = negExpImprove
-            fargs = (self.model, y_best, self.acq_func[1], alpha)
-
-        # gaussian process upper confidence bound acquisition function
-        elif(self.acq_func[0] == 'UCB'):
-            aqfcn = negUCB
-            fargs = (self.model, ndim, nsteps, self.ucb_params[0], self.ucb_params[1])
+        # probability of improvement, expected improvement or gaussian
+        # process upper confidence bound acquisition function
+        if(self.acq_func[0] in ['PI', 'EI', 'UCB']):
+            (aqfcn, fargs) = self.acqFunction(y_best, ndim, nsteps, alpha)
 
         # maybe something mitch was using once? (can probably remove)
         elif(self.acq_func[0] == 'testEI'):
@@ -257,12 +470,9 @@ class BayesOpt:
             options = np.array(self.acq_func[2].iloc[:, :-1])
             (x_best, y_best) = self.best_seen()
 
-            # find the option with best EI
-            best_option_score = (-1,1e12)
-            for i in range(options.shape[0]):
-                result = negExpImprove(options[i],self.model,y_best,self.acq_func[1])
-                if(result < best_option_score[1]):
-                    best_option_score = (i, result)
+            # find the option with best EI, all at once
+            scores = negExpImprove(options,self.model,y_best,self.acq_func[1])
+            best_option_score = (scores.argmin(), scores.min())
 
             # return the index of the best option
             return best_option_score[0]
@@ -273,7 +483,11 @@ class BayesOpt:
 
         try:
 
-            if(self.multiprocessingQ): # multi-processing to speed search
+            if(self.acq_mode == 'candidates'): # batched scoring of a candidate pool
+
+                (res, candidates) = self.acquireCandidates(aqfcn, fargs, x_start, iter_bounds, tolerance, deadline)
+
+            elif(self.multiprocessingQ): # multi-processing to speed search
 
                 neval = 2*int(10.*2.**(ndim/12.))
                 nkeep = 2*min(8,neval)
@@ -291,19 +505,26 @@ class BayesOpt:
 #                 nstart = 1 # make sure some starting points are there to prevent run away searches
 
 
-                yobs = np.array([y[0][0] for y in self.Y_obs])
+                yobs = np.array([y[0][0] for y in self.Y_obs[:len(self.Y_obs) - self.nfantasy]])
                 isearch = yobs.argsort()[-nbest:]
-                for i in range(min(nstart,len(self.Y_obs))): #
+                for i in range(min(nstart,len(yobs))): #
                     if np.sum(isearch == i) == 0: # not found in list
                         isearch = np.append(isearch, i)
                         isearch.sort() # sort to bias searching near earlier steps
 
                 v0s = None
 
+                # ship the model to the workers once for this acquisition
+                #   (without a pool each search spawns its own processes)
+                if self.pool is not None:
+                    self.pool.share(self.model)
 
                 for i in isearch:
 
-                    vs = parallelgridsearch(aqfcn,self.X_obs[i],self.searchBoundScaleFactor * 0.6*self.lengthscales,fargs,neval,nkeep)
+                    if(deadline is not None and v0s is not None and time.time() > deadline):
+                        break
+
+                    vs = parallelgridsearch(aqfcn,self.X_obs[i],self.lengthCache()['grid_lengths'],fargs,neval,nkeep,pool=self.pool)
 
                     if type(v0s) == type(None):
                         v0s = copy.copy(vs)
@@ -315,98 +536,150 @@ class BayesOpt:
 
                 x0s = v0s[:,:-1] # for later testing if the minimize results are better than the best starting point
                 v0best = v0s[0]
+                candidates = x0s
+
 
 
+                if(deadline is not None and time.time() > deadline):
+                    # out of time, take the best grid point
+                    res = np.array(v0best[:-1])
 
-                if basinhoppingQ:
+                elif basinhoppingQ:
                     # use basinhopping
-                    bkwargs = dict(niter=niter,niter_success=niter_success, minimizer_kwargs={'method':optmethod,'args':fargs,'tol':tolerance,'bounds':iter_bounds,'options':{'maxiter':maxiter}}) # keyword args for basinhopping
+                    bkwargs = dict(niter=niter,niter_success=niter_success, minimizer_kwargs={'method':optmethod,'args':fargs+(True,),'jac':True,'tol':tolerance,'bounds':iter_bounds,'options':{'maxiter':maxiter}}) # keyword args for basinhopping
                     res = parallelbasinhopping(aqfcn,x0s,bkwargs)
 
                 else:
                     # use minimize
-                    mkwargs = dict(bounds=iter_bounds, method=optmethod, options={'maxiter':maxiter}, tol=tolerance) # keyword args for scipy.optimize.minimize
-                    res = parallelminimize(aqfcn,x0s,fargs,mkwargs,v0best,relative_bounds=relative_bounds)
+                    mkwargs = dict(bounds=iter_bounds, method=optmethod, jac=True, options={'maxiter':maxiter}, tol=tolerance) # keyword args for scipy.optimize.minimize
+                    res = parallelminimize(aqfcn,x0s,fargs+(True,),mkwargs,v0best,relative_bounds=relative_bounds,pool=self.pool,deadline=deadline)
 
             else: # single-processing
 
-                if basinhoppingQ:
-                    res = basinhopping(aqfcn, x_start,niter=niter,niter_success=niter_success, minimizer_kwargs={'method':optmethod,'args':(self.model, y_best, self.acq_func[1], alpha),'tol':tolerance,'bounds':iter_bounds,'options':{'maxiter':maxiter}})
+                candidates = np.empty((0, ndim))
+                f = aqfcn if deadline is None else DeadlineObjective(aqfcn, deadline)
+                try:
+                    if basinhoppingQ:
+                        res = basinhopping(f, x_start,niter=niter,niter_success=niter_success, minimizer_kwargs={'method':optmethod,'args':fargs+(True,),'jac':True,'tol':tolerance,'bounds':iter_bounds,'options':{'maxiter':maxiter}})
 
-                else:
-                    res = minimize(aqfcn, x_start, args=(self.model, y_best, self.acq_func[1], alpha), method=optmethod,tol=tolerance,bounds=iter_bounds,options={'maxiter':maxiter})
+                    else:
+                        res = minimize(f, x_start, args=fargs+(True,), jac=True, method=optmethod,tol=tolerance,bounds=iter_bounds,options={'maxiter':maxiter})
+
+                    res = res.x
 
-                res = res.x
+                except DeadlineReached:
+                    # out of time, take the best point the search got to
+                    res = x_start if f.xbest is None else f.xbest
 
         except:
             raise
+
+        # the best points looked at, for re-ranking them later (see OptIter)
+        self.last_candidates = np.vstack((np.array(res, ndmin=2), candidates))
+
         return np.array(res,ndmin=2) # return resulting x value as a (1 x dim) vector
 
 
-def negProbImprove(x_new, model, y_best, xi):
+def negProbImprove(x_new, model, y_best, xi, jac=False):
     """
     The probability of improvement acquisition function. Initial testing
     shows that it performs worse than expected improvement acquisition
     function for 2D scans (at least when alpha==1 in the fcn below). Alse
     performs worse than EI according to the literature.
+
+    x_new may hold one point per row, returns one value per row.
+    With jac=True returns the value and its gradient, for minimize(jac=True).
     """
-    (y_mean, y_var) = model.predict(np.array(x_new,ndmin=2))
-    diff = y_mean - y_best - xi
-    if(y_var == 0):
-        return 0.
+    x_new = np.array(x_new, ndmin=2)
+    if jac:
+        (y_mean, y_var, dmean, dvar) = model.predictGrad(x_new)
     else:
-        Z = diff / np.sqrt(y_var)
+        (y_mean, y_var) = model.predictBatch(x_new)
+    diff = y_mean - y_best - xi
+
+    # points without variance get 0
+    valid = y_var > 0
+    sigma = np.sqrt(np.where(valid, y_var, 1.))
+    Z = diff / sigma
+    value = np.where(valid, -norm.cdf(Z), 0.)
 
-    return -norm.cdf(Z)
+    if jac:
+        # dZ = dmean / sigma - Z dsigma / sigma, dsigma = dvar / (2 sigma)
+        dZ = (dmean - 0.5 * Z * dvar / sigma) / sigma
+        return value.item(), np.where(valid, -norm.pdf(Z) * dZ, 0.).ravel()
+    return value
 
 
-def negExpImprove(x_new, model, y_best, xi, alpha=1.0):
+def negExpImprove(x_new, model, y_best, xi, alpha=1.0, jac=False):
     """
     The common acquisition function, expected improvement. Returns the
     negative for the minimizer (so that EI is maximized). Alpha attempts
     to control the ratio of exploration to exploitation, but seems to not
     work well in practice. The terminate() method is a better choice.
+
+    x_new may hold one point per row, returns one value per row.
+    With jac=True returns the value and its gradient, for minimize(jac=True).
     """
-    (y_mean, y_var) = model.predict(np.array(x_new, ndmin=2))
+    x_new = np.array(x_new, ndmin=2)
+    if jac:
+        (y_mean, y_var, dmean, dvar) = model.predictGrad(x_new)
+    else:
+        (y_mean, y_var) = model.predictBatch(x_new)
     diff = y_mean - y_best - xi
 
-    # Nonvectorizable. Can prob use slicing to do the same.
-    if(y_var == 0):
-        return 0.
-    else:
-        Z = diff / np.sqrt(y_var)
+    # points without variance get 0
+    valid = y_var > 0
+    sigma = np.sqrt(np.where(valid, y_var, 1.))
+    Z = diff / sigma
 
-    EI = diff * norm.cdf(Z) + np.sqrt(y_var) * norm.pdf(Z)
-    return alpha * (-EI) + (1. - alpha) * (-y_mean)
+    EI = diff * norm.cdf(Z) + sigma * norm.pdf(Z)
+    value = np.where(valid, alpha * (-EI) + (1. - alpha) * (-y_mean), 0.)
+
+    if jac:
+        # dEI/dmean = cdf(Z) and dEI/dsigma = pdf(Z)
+        dEI = norm.cdf(Z) * dmean + norm.pdf(Z) * 0.5 * dvar / sigma
+        grad = np.where(valid, alpha * (-dEI) + (1. - alpha) * (-dmean), 0.)
+        return value.item(), grad.ravel()
+    return value
 
 
 # GP upper confidence bound
 # original paper: https://arxiv.org/pdf/0912.3995.pdf
 # tutorial: http://www.cs.ubc.ca/~nando/540-2013/lectures/l7.pdf
-def negUCB(x_new, model, ndim, nsteps, nu = 1., delta = 1.):
+def negUCB(x_new, model, ndim, nsteps, nu = 1., delta = 1., jac=False):
     """
     GPUCB: Gaussian process upper confidence bound aquisition function
     Default nu and delta hyperparameters theoretically yield "least regret".
     Works better than "expected improvement" (for alpha==1 above) in 2D.
 
     input params
-    x_new: new point in the dim-dimensional space the GP is fitting
+    x_new: new point(s) in the dim-dimensional space the GP is fitting, one per row
     model: OnlineGP object
     ndim: feature space dimensionality (how many devices are varied)
     nsteps: current step number counting from 1
     nu: nu in the tutorial (see above)
     delta: delta in the tutorial (see above)
+    jac: also return the gradient, for minimize(jac=True)
     """
 
     if nsteps==0: nsteps += 1
-    (y_mean, y_var) = model.predict(np.array(x_new,ndmin=2))
+    x_new = np.array(x_new, ndmin=2)
+    if jac:
+        (y_mean, y_var, dmean, dvar) = model.predictGrad(x_new)
+    else:
+        (y_mean, y_var) = model.predictBatch(x_new)
 
     if delta is None:
-        GPUCB = y_mean + nu * np.sqrt(y_var)
+        scale = nu
     else:
         tau = 2.*np.log(nsteps**(0.5*ndim+2.)*(np.pi**2.)/3./delta)
-        GPUCB = y_mean + np.sqrt(nu * tau * y_var)
+        scale = np.sqrt(nu * tau)
+    sigma = np.sqrt(np.maximum(y_var, 0.))
+    GPUCB = y_mean + scale * sigma
 
+    if jac:
+        dsigma = 0.5 * dvar / np.maximum(sigma, 1.e-150)
+        return -GPUCB.item(), -(dmean + scale * dsigma).ravel()
     return -GPUCB
 
 # old version
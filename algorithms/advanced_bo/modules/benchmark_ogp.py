@@ -0,0 +1,141 @@
+# -*- coding: iso-8859-1 -*-
+"""
+Throughput benchmarks for the OnlineGP model.
+
+Run from the algorithms directory:
+
+    python -m advanced_bo.modules.benchmark_ogp
+"""
+
+import time
+import numpy as np
+from .OnlineGP import OGP
+from .kernels import available_backends
+
+
+def makeModel(dim, maxBV, **kwargs):
+    # short length scales so that random points are novel enough to become BVs
+    hyps = [4. * np.eye(dim), np.log(1.), np.log(0.01)]
+    return OGP(dim, hyps, maxBV=maxBV, **kwargs)
+
+
+def timeUpdates(gp, X, Y):
+    t0 = time.time()
+    for i in range(X.shape[0]):
+        gp.update(np.array(X[i], ndmin=2), np.array([[Y[i]]]))
+    return time.time() - t0
+
+
+def benchmarkUpdates(maxBVs=(50, 200, 1000), dim=10, nupdates=100, seed=0):
+    # fills the model up to maxBV, then times steady state updates where
+    #   every update adds a BV and removes another one
+    print('update throughput [updates/s]')
+    print('maxBV    solve/inv    cholesky')
+    for maxBV in maxBVs:
+        rates = []
+        for choleskyQ in [False, True]:
+            rng = np.random.RandomState(seed)
+            X = 3. * rng.randn(maxBV + nupdates, dim)
+            Y = np.sin(X).sum(axis=1)
+
+            gp = makeModel(dim, maxBV, choleskyQ=choleskyQ)
+            timeUpdates(gp, X[:maxBV], Y[:maxBV])
+            dt = timeUpdates(gp, X[maxBV:], Y[maxBV:])
+            rates += [nupdates / dt]
+        print('%5d %12.1f %11.1f' % (maxBV, rates[0], rates[1]))
+
+
+def loopScores(gp):
+    # the one divergence at a time way of scoring weighted BVs
+    scores = np.zeros((gp.numBV, 1))
+    for removed in range(gp.numBV):
+        (hatalpha, hatC) = gp.getUpdatedParams(removed)
+        scores[removed] = gp.computeWeightedDiv(hatalpha, hatC, removed)
+    return scores
+
+
+def benchmarkPruning(maxBVs=(100, 200, 500), dim=10, seed=0, maxtime=10.):
+    # times scoring all BVs of a full weighted model for removal, which is
+    #   what each pruning step does. The loop is stopped after maxtime seconds
+    print('pruning throughput [BV scorings/s]')
+    print('maxBV         loop  vectorized   max rel diff')
+    for maxBV in maxBVs:
+        rng = np.random.RandomState(seed)
+        X = 3. * rng.randn(maxBV, dim)
+        Y = np.sin(X).sum(axis=1)
+
+        gp = makeModel(dim, maxBV, weighted=True)
+        timeUpdates(gp, X, Y)
+
+        # scoring doesn't change the model, repeat until enough time passed
+        rates = []
+        for scorer in [loopScores, OGP.weightedScores]:
+            count = 0
+            t0 = time.time()
+            while count == 0 or time.time() - t0 < 1.:
+                scores = scorer(gp)
+                count += 1
+                if time.time() - t0 > maxtime:
+                    break
+            rates += [count / (time.time() - t0)]
+            if scorer is loopScores:
+                reference = scores
+
+        finite = np.isfinite(reference)
+        diff = np.abs(scores - reference)[finite] / np.abs(reference[finite])
+        print('%5d %12.3f %11.1f %14.1e' % (maxBV, rates[0], rates[1],
+                                             diff.max()))
+
+
+def benchmarkFit(npoints=2000, maxBVs=(50, 100), dim=4, ntest=1000, seed=0):
+    # warm start from a scan of npoints, batch fit against updating row by
+    #   row: time and RMSE on held out points
+    print('warm start from %d points' % npoints)
+    print('maxBV   rowwise [s]  batch [s]   rowwise RMSE  batch RMSE')
+    for maxBV in maxBVs:
+        rng = np.random.RandomState(seed)
+        X = rng.uniform(-2., 2., (npoints + ntest, dim))
+        Y = np.sin(X).sum(axis=1)
+
+        times = []
+        errors = []
+        for batchQ in [False, True]:
+            gp = makeModel(dim, maxBV)
+            t0 = time.time()
+            gp.fit(X[:npoints], Y[:npoints], batchQ=batchQ)
+            times += [time.time() - t0]
+            (mean, var) = gp.predictBatch(X[npoints:])
+            errors += [np.sqrt(np.mean((mean.ravel() - Y[npoints:]) ** 2))]
+        print('%5d %13.2f %10.2f %14.3f %11.3f' % (maxBV, times[0], times[1],
+                                                  errors[0], errors[1]))
+
+
+def benchmarkKernels(npoints=2048, nBV=200, dim=10, nrepeat=20, seed=0):
+    # covariance of a batch of points with the BVs, as in predictBatch, for
+    #   every available backend in double and single precision
+    print('kernel evaluation, %d x %d [ms]' % (npoints, nBV))
+    print('backend      float64   float32')
+    rng = np.random.RandomState(seed)
+    X = rng.randn(npoints, dim)
+    BV = rng.randn(nBV, dim)
+    for backend in available_backends():
+        gp = makeModel(dim, nBV, backend=backend)
+        times = []
+        for dtype in [np.float64, np.float32]:
+            out = np.empty((npoints, nBV), dtype=dtype)
+            gp.computeCov(X, BV, out=out) # numba compiles on the first call
+            t0 = time.time()
+            for i in range(nrepeat):
+                gp.computeCov(X, BV, out=out)
+            times += [1e3 * (time.time() - t0) / nrepeat]
+        print('%-8s %11.2f %9.2f' % (backend, times[0], times[1]))
+
+
+if __name__ == '__main__':
+    benchmarkUpdates()
+    print()
+    benchmarkPruning()
+    print()
+    benchmarkFit()
+    print()
+    benchmarkKernels()
@@ -223,23 +223,27 @@ def create_halton_samples(order, dim=1, burnin=None, primes=None):
     Returns (numpy.ndarray):
         Halton sequence with ``shape == (dim, order)``.
     """
+    return HaltonGenerator(dim, burnin=burnin, primes=primes).get(0, order)
+
+
+def _halton_primes(dim, primes=None):
     if primes is None:
         primes = []
         prime_order = 10*dim
         while len(primes) < dim:
             primes = create_primes(prime_order)
             prime_order *= 2
-    primes = primes[:dim]
+    primes = tuple(int(prime) for prime in primes[:dim])
     assert len(primes) == dim, "not enough primes"
+    return primes
 
-    if burnin is None:
-        burnin = max(primes)
 
-    out = numpy.empty((dim, order))
-    indices = [idx+burnin for idx in range(order)]
-    for dim_ in range(dim):
+def _create_halton_samples(start, order, burnin, primes):
+    out = numpy.empty((len(primes), order))
+    indices = numpy.arange(start, start+order) + burnin
+    for dim_, prime in enumerate(primes):
         out[dim_] = create_van_der_corput_samples(
-            indices, number_base=primes[dim_])
+            indices, number_base=prime)
     return out
 """
 Create samples from the `Hammersley set`_.
@@ -315,11 +319,17 @@ def create_hammersley_samples(order, dim=1, burnin=None, primes=None):
     if dim == 1:
         return create_halton_samples(
             order=order, dim=1, burnin=burnin, primes=primes)
-    out = numpy.empty((dim, order), dtype=float)
-    out[:dim-1] = create_halton_samples(
-        order=order, dim=dim-1, burnin=burnin, primes=primes)
-    out[dim-1] = numpy.linspace(0, 1, order+2)[1:-1]
-    return out
+
+    halton = HaltonGenerator(dim-1, burnin=burnin, primes=primes)
+
+    def create():
+        out = numpy.empty((dim, order), dtype=float)
+        out[:dim-1] = halton.get(0, order)
+        out[dim-1] = numpy.linspace(0, 1, order+2)[1:-1]
+        return out
+
+    return _cached(
+        ("hammersley", dim, order, halton.burnin, halton.primes), create).copy()
 """
 Generate samples from `low-discrepancy sequences`_.
 
@@ -578,64 +588,73 @@ def create_sobol_samples(order, dim, seed=None):
         quasi (numpy.ndarray):
             Quasi-random vector with ``shape == (dim, order+1)``.
     """
+    if seed is None:
+        # consecutive samples share the module state, which is not safe
+        # across processes; use a SobolGenerator per process instead
+        seed = RANDOM_SEED
+        set_state(step=order+1)
+
+    return SobolGenerator(dim, seed=seed).get(0, order+1)
+
+
+def _sobol_directions(dim):
+    """Direction numbers of the first ``dim`` dimensions, ``shape == (dim, maxcol)``."""
     assert 0 < dim < DIM_MAX, "dim in [1, 40]"
 
-    # global RANDOM_SEED  # pylint: disable=global-statement
-    # if seed is None:
-    #     seed = RANDOM_SEED
-    # RANDOM_SEED += order+1
-    set_state(seed_value=seed)
-    seed = RANDOM_SEED
-    set_state(step=order+1)
+    def create():
+        # Initialize row 1 of V.
+        samples = SOURCE_SAMPLES.copy()
+        maxcol = int(math.log(2**LOG_MAX-1, 2))+1
+        samples[0, 0:maxcol] = 1
 
-    # Initialize row 1 of V.
-    samples = SOURCE_SAMPLES.copy()
-    maxcol = int(math.log(2**LOG_MAX-1, 2))+1
-    samples[0, 0:maxcol] = 1
+        # Initialize the remaining rows of V.
+        for idx in range(1, dim):
 
-    # Initialize the remaining rows of V.
-    for idx in range(1, dim):
+            # The bits of the integer POLY(I) gives the form of polynomial:
+            degree = int(math.log(POLY[idx], 2))
 
-        # The bits of the integer POLY(I) gives the form of polynomial:
-        degree = int(math.log(POLY[idx], 2))
+            #Expand this bit pattern to separate components:
+            includ = numpy.array([val == "1" for val in bin(POLY[idx])[-degree:]])
 
-        #Expand this bit pattern to separate components:
-        includ = numpy.array([val == "1" for val in bin(POLY[idx])[-degree:]])
+            #Calculate the remaining elements of row I as explained
+            #in Bratley and Fox, section 2.
+            for idy in range(degree+1, maxcol+1):
+                newv = samples[idx, idy-degree-1].item()
+                base = 1
+                for idz in range(1, degree+1):
+                    base *= 2
+                    if includ[idz-1]:
+                        newv = newv ^ base * samples[idx, idy-idz-1].item()
+                samples[idx, idy-1] = newv
 
-        #Calculate the remaining elements of row I as explained
-        #in Bratley and Fox, section 2.
-        for idy in range(degree+1, maxcol+1):
-            newv = samples[idx, idy-degree-1].item()
-            base = 1
-            for idz in range(1, degree+1):
-                base *= 2
-                if includ[idz-1]:
-                    newv = newv ^ base * samples[idx, idy-idz-1].item()
-            samples[idx, idy-1] = newv
+        samples = samples[:dim, :maxcol]
 
-    samples = samples[:dim]
+        # Multiply columns of V by appropriate power of 2.
+        return samples * 2**(numpy.arange(maxcol, 0, -1, dtype=numpy.int64))
 
-    # Multiply columns of V by appropriate power of 2.
-    samples *= 2**(numpy.arange(maxcol, 0, -1, dtype=int))
+    return _cached(("sobol_directions", dim), create)
 
-    #RECIPD is 1/(common denominator of the elements in V).
-    recipd = 0.5**(maxcol+1)
-    lastq = numpy.zeros(dim, dtype=int)
 
-    seed = int(seed) if seed > 1 else 1
+def _create_sobol_samples(directions, indices):
+    """
+    Sobol samples at the given indices, all at once.
 
-    for seed_ in range(seed):
-        lowbit = len(bin(seed_)[2:].split("0")[-1])
-        lastq[:] = lastq ^ samples[:, lowbit]
+    Stepping from sample ``n`` to ``n+1`` flips the direction numbers of the
+    lowest zero bit of ``n``, so sample ``n`` is the xor of the direction
+    numbers of the bits set in its Gray code ``n ^ (n >> 1)``.
+    """
+    maxcol = directions.shape[1]
+    indices = numpy.asarray(indices, dtype=numpy.int64)
+    gray = indices ^ (indices >> 1)
 
-    #Calculate the new components of QUASI.
-    quasi = numpy.empty((dim, order+1))
-    for idx in range(order+1):
-        lowbit = len(bin(seed+idx)[2:].split("0")[-1])
-        quasi[:, idx] = lastq * recipd
-        lastq[:] = lastq ^ samples[:, lowbit]
+    out = numpy.zeros((len(directions), len(indices)), dtype=numpy.int64)
+    for bit in range(maxcol):
+        flip = (gray >> bit) & 1 == 1
+        out[:, flip] ^= directions[:, bit:bit+1]
 
-    return quasi
+    #RECIPD is 1/(common denominator of the elements in V).
+    recipd = 0.5**(maxcol+1)
+    return out * recipd
 """
 Create `Van Der Corput` low discrepancy sequence samples.
 
@@ -681,15 +700,141 @@ def create_van_der_corput_samples(idx, number_base=2):
     """
     assert number_base > 1
 
-    idx = numpy.asarray(idx).flatten() + 1
+    idx = numpy.asarray(idx, dtype=numpy.int64).flatten() + 1
     out = numpy.zeros(len(idx), dtype=float)
 
     base = float(number_base)
     active = numpy.ones(len(idx), dtype=bool)
     while numpy.any(active):
         out[active] += (idx[active] % number_base)/base
-        #idx /= number_base # python 3 can't deal with this...
-        idx = idx/number_base
+        idx = idx // number_base
         base *= number_base
         active = idx > 0
     return out
+"""
+Stateful low-discrepancy sequence generators.
+
+The generators keep their position in the sequence, so consecutive calls to
+``next`` continue it and ``skip`` jumps ahead without generating the samples
+in between. They hold no module state, so every worker process can have its
+own. Direction numbers and sequence prefixes are cached in memory per process,
+keyed by dimension and order.
+
+Example usage
+-------------
+
+Continuing a sequence::
+
+    >>> sobol = SobolGenerator(dim=2, seed=1000)
+    >>> print(sobol.next(3))
+    [[ 0.21972656  0.71972656  0.96972656]
+     [ 0.09667969  0.59667969  0.34667969]]
+    >>> print(sobol.next(3))
+    [[ 0.46972656  0.34472656  0.84472656]
+     [ 0.84667969  0.47167969  0.97167969]]
+
+Skipping ahead::
+
+    >>> halton = HaltonGenerator(dim=2)
+    >>> halton.skip(1)
+    >>> print(halton.next(2))
+    [[ 0.625       0.375     ]
+     [ 0.77777778  0.22222222]]
+"""
+from collections import OrderedDict
+
+CACHE_SIZE = 32
+_CACHE = OrderedDict()
+
+
+def _cached(key, create):
+    """Least recently used cache of read-only arrays."""
+    try:
+        out = _CACHE.pop(key)
+    except KeyError:
+        out = create()
+        out.setflags(write=False)
+    _CACHE[key] = out
+    while len(_CACHE) > CACHE_SIZE:
+        _CACHE.popitem(last=False)
+    return out
+
+
+class _SequenceGenerator(object):
+    """Position keeping for the generators below."""
+
+    def __init__(self):
+        self.index = 0
+
+    def reset(self, index=0):
+        """Go back to the start of the sequence, or to ``index``."""
+        self.index = index
+
+    def skip(self, count):
+        """Skip the next ``count`` samples."""
+        self.index += count
+
+    def next(self, count):
+        """The next ``count`` samples, ``shape == (dim, count)``."""
+        out = self.get(self.index, count)
+        self.index += count
+        return out
+
+    def get(self, start, count):
+        """Samples ``start`` to ``start+count-1``, without moving the position."""
+        if start == 0:
+            return _cached(self._key(count), lambda: self._create(0, count)).copy()
+        return self._create(start, count)
+
+
+class HaltonGenerator(_SequenceGenerator):
+    """
+    Halton sequence, see ``create_halton_samples``.
+
+    Args:
+        dim (int):
+            The number of dimensions in the Halton sequence.
+        burnin (int, optional):
+            Skip the first ``burnin`` samples. If omitted, the maximum of
+            ``primes`` is used.
+        primes (array_like, optional):
+            The (non-)prime base to calculate values along each axis. If
+            omitted, growing prime values starting from 2 will be used.
+    """
+
+    def __init__(self, dim=1, burnin=None, primes=None):
+        super(HaltonGenerator, self).__init__()
+        self.dim = dim
+        self.primes = _halton_primes(dim, primes)
+        self.burnin = max(self.primes) if burnin is None else burnin
+
+    def _key(self, order):
+        return ("halton", self.dim, order, self.burnin, self.primes)
+
+    def _create(self, start, count):
+        return _create_halton_samples(start, count, self.burnin, self.primes)
+
+
+class SobolGenerator(_SequenceGenerator):
+    """
+    Sobol sequence, see ``create_sobol_samples``.
+
+    Args:
+        dim (int):
+            Number of spacial dimensions. Must satisfy ``0 < dim < 41``.
+        seed (int):
+            Index of the first sample. Non-positive values are treated as 1.
+    """
+
+    def __init__(self, dim, seed=1):
+        super(SobolGenerator, self).__init__()
+        self.dim = dim
+        self.seed = int(seed) if seed > 1 else 1
+        self.directions = _sobol_directions(dim)
+
+    def _key(self, order):
+        return ("sobol", self.dim, order, self.seed)
+
+    def _create(self, start, count):
+        indices = numpy.arange(start, start+count) + self.seed
+        return _create_sobol_samples(self.directions, indices)
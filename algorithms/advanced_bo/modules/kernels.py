@@ -0,0 +1,204 @@
+# -*- coding: iso-8859-1 -*-
+"""
+Covariance functions of the OnlineGP model, with their hyperparameters
+preprocessed once.
+
+All the supported kernels only depend on the distance of two points under a
+precision matrix P, i.e. on (x1 - x2)^T P (x1 - x2). With P = L L^T that is
+the squared euclidean distance of x1 L and x2 L, so a Kernel keeps the factor
+L (a scaling vector if P is diagonal) and each evaluation transforms the
+inputs once instead of multiplying by P row by row.
+
+Kernel types:
+    'RBF': coeff * exp(-d^2 / 2)
+    'Matern': coeff * poly(d) * exp(-sqrt(2 nu) d), for nu in (1.5, 2.5)
+
+Backends, selected with the backend argument:
+    'numpy': always available
+    'numexpr': fuses the elementwise part into one pass, needs numexpr
+    'numba': compiled loops over the points, needs numba
+The numpy one is usually fastest on a single core, the others spread the
+work over all cores.
+
+Example usage
+-------------
+
+    >>> kernel = Kernel(np.log([[2., 0.5]]), np.log(1.))
+    >>> K = kernel(x1, x2)
+    >>> kernel(x1, x2, out=K)  # reuses the memory of K
+
+Passing dtype=np.float32 evaluates in single precision.
+"""
+
+import numpy as np
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def available_backends():
+    backends = ['numpy']
+    if numexpr is not None:
+        backends += ['numexpr']
+    if numba is not None:
+        backends += ['numba']
+    return backends
+
+
+class Kernel(object):
+    def __init__(self, hyp_ARD, hyp_coeff, precisionMatrix=None, kind='RBF',
+                 nu=2.5, dtype=np.float64, backend='numpy'):
+        # hyp_ARD and hyp_coeff are the logged OnlineGP hyperparameters, an
+        #   unlogged precisionMatrix replaces hyp_ARD when given
+
+        if kind not in ['RBF', 'Matern']:
+            raise Exception(f'Unknown kernel type {kind}')
+        if kind == 'Matern' and nu not in [1.5, 2.5]:
+            raise Exception(f'Invalid nu {nu} (only 1.5 and 2.5 supported)')
+        if backend not in available_backends():
+            raise Exception(f'Kernel backend {backend} is not available, '
+                            f'choose from {available_backends()}')
+
+        self.kind = kind
+        self.nu = nu
+        self.dtype = np.dtype(dtype)
+        self.backend = backend
+        self.coeff = self.dtype.type(np.exp(hyp_coeff))
+
+        if precisionMatrix is None:
+            b = np.exp(np.asarray(hyp_ARD, dtype=float))
+            if b.ndim == 2 and b.shape[0] == b.shape[1] and b.shape[0] > 1:
+                self.precision = b
+            else:
+                self.precision = np.diagflat(b)
+        else:
+            self.precision = np.asarray(precisionMatrix, dtype=float)
+
+        # inputs are scaled by a vector for diagonal precisions, otherwise
+        #   multiplied by a factor L with P = L L^T: the Cholesky factor, or
+        #   for a singular P the eigenvectors scaled by the square roots of
+        #   the eigenvalues, which are clipped at 0
+        P = self.precision
+        if np.count_nonzero(P - np.diag(P.diagonal())) == 0:
+            self.scaling = np.sqrt(P.diagonal()).astype(self.dtype)
+            self.factor = None
+        else:
+            self.scaling = None
+            try:
+                factor = np.linalg.cholesky(P)
+            except np.linalg.LinAlgError:
+                (w, V) = np.linalg.eigh(P)
+                factor = V * np.sqrt(np.maximum(w, 0))
+            self.factor = factor.astype(self.dtype)
+
+    def transform(self, x):
+        # maps points so that kernel distances are euclidean distances
+        x = np.asarray(x, dtype=self.dtype)
+        if self.factor is None:
+            return x * self.scaling
+        return np.dot(x, self.factor)
+
+    def __call__(self, x1, x2, out=None):
+        # (n1 x n2) covariance of the rows of x1 and x2, written into out if
+        #   given, which must be a C-contiguous array of the kernel's dtype
+        n1 = x1.shape[0]
+        n2 = x2.shape[0]
+        if out is None:
+            out = np.empty((n1, n2), dtype=self.dtype)
+        elif out.shape != (n1, n2) or out.dtype != self.dtype or not out.flags.c_contiguous:
+            raise Exception(f'Kernel output buffer must be a C-contiguous '
+                            f'({n1}, {n2}) {self.dtype} array')
+
+        z1 = self.transform(x1)
+        z2 = self.transform(x2)
+        if self.backend == 'numba':
+            if self.kind == 'RBF':
+                _numbaRBF(z1, z2, self.coeff, out)
+            else:
+                _numbaMatern(z1, z2, self.coeff, self.nu, out)
+            return out
+
+        # squared distances from the inner products, clipped since rounding
+        #   can make them slightly negative
+        s1 = np.einsum('ij,ij->i', z1, z1)[:,None]
+        s2 = np.einsum('ij,ij->i', z2, z2)[None,:]
+        np.dot(z1, z2.transpose(), out=out)
+
+        if self.backend == 'numexpr':
+            _numexprKernel(self, out, s1, s2)
+            return out
+
+        out *= -2
+        out += s1
+        out += s2
+        np.maximum(out, 0, out=out)
+        if self.kind == 'RBF':
+            out *= -0.5
+            np.exp(out, out=out)
+            out *= self.coeff
+            return out
+
+        d = np.sqrt(out)
+        r = np.sqrt(2 * self.nu, dtype=self.dtype)
+        if self.nu == 1.5:
+            poly = 1 + r * d
+        else:
+            poly = 1 + r * d + (5 / 3) * out
+        d *= -r
+        np.exp(d, out=out)
+        out *= poly
+        out *= self.coeff
+        return out
+
+
+def _numexprKernel(kernel, out, s1, s2):
+    # the elementwise part of Kernel.__call__ in one pass, out holds the
+    #   inner products on entry
+    coeff = kernel.coeff
+    if kernel.kind == 'RBF':
+        numexpr.evaluate('coeff * exp(-0.5 * where(s1 + s2 - 2 * out > 0, s1 + s2 - 2 * out, 0))',
+                         out=out, casting='same_kind')
+        return
+
+    r = np.sqrt(2 * kernel.nu, dtype=kernel.dtype)
+    c = kernel.dtype.type(5 / 3) if kernel.nu == 2.5 else kernel.dtype.type(0)
+    numexpr.evaluate('where(s1 + s2 - 2 * out > 0, s1 + s2 - 2 * out, 0)',
+                     out=out, casting='same_kind')
+    numexpr.evaluate('coeff * (1 + r * sqrt(out) + c * out) * exp(-r * sqrt(out))',
+                     out=out, casting='same_kind')
+
+
+if numba is not None:
+    # rows are spread over numba's threads
+    @numba.njit(parallel=True)
+    def _numbaRBF(z1, z2, coeff, out):
+        # distances are summed directly, which needs no clipping
+        for i in numba.prange(z1.shape[0]):
+            for j in range(z2.shape[0]):
+                d2 = 0.
+                for k in range(z1.shape[1]):
+                    t = z1[i,k] - z2[j,k]
+                    d2 += t * t
+                out[i,j] = coeff * np.exp(-0.5 * d2)
+
+    @numba.njit(parallel=True)
+    def _numbaMatern(z1, z2, coeff, nu, out):
+        r = np.sqrt(2 * nu)
+        for i in numba.prange(z1.shape[0]):
+            for j in range(z2.shape[0]):
+                d2 = 0.
+                for k in range(z1.shape[1]):
+                    t = z1[i,k] - z2[j,k]
+                    d2 += t * t
+                d = np.sqrt(d2)
+                poly = 1 + r * d
+                if nu == 2.5:
+                    poly += (5 / 3) * d2
+                out[i,j] = coeff * poly * np.exp(-r * d)
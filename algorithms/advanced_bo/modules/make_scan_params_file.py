@@ -1,13 +1,15 @@
 # -*- coding: iso-8859-1 -*-
 
 #How to make your own scan parameter file:
-#1) On line 10, choose a unique filename.
-#2) On lines 15-36, replace the expressions to the right of the assignment statements with the desired values (maintain formatting)
-#3) Run this file from the /basic_gp_stuff/ directory.
+#1) On line 11, choose a unique filename.
+#2) On lines 16-37, replace the expressions to the right of the assignment statements with the desired values (maintain formatting)
+#3) Run this file from the algorithms directory with python -m advanced_bo.modules.make_scan_params_file
 
+import os
 import numpy as np
+from advanced_bo.modules.scan_params import save_scan_params
 
-filename = 'scan_params_JOE.npy'
+filename = 'scan_params_JOE.npz'
 
 my_scan_params = {}
 
@@ -35,4 +37,4 @@ my_scan_params['start_point'] = np.array([ 0., 0., 0., 0.])
 #UCB acquisition function parameters in order [nu, delta], list of length 2. If delta is None, ucb will do a fixed tail search using nu as a zscore
 my_scan_params['ucb_params'] = [1.0, None] 
 
-np.save('params/'+filename, my_scan_params)
\ No newline at end of file
+save_scan_params(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'params', filename), my_scan_params)
\ No newline at end of file
@@ -6,7 +6,10 @@ recovery_sleep_time_seconds = 1 # number of seconds to wait before trying to lau
 
 import numpy as np
 import multiprocessing as mp
+from multiprocessing import shared_memory
 import copy
+import pickle
+import time
 
 # handle 'IOError: [Errno 4] Interrupted system call' errors from multiprocessing.Queue.get
 #https://stackoverflow.com/questions/14136195/what-is-the-proper-way-to-handle-in-python-ioerror-errno-4-interrupted-syst
@@ -20,6 +23,212 @@ def my_queue_get(queue, block=True, timeout=None):
                 raise
 # Now replace instances of queue.get() with my_queue_get(queue), with other
 # parameters passed as usual.
+
+def spawnbatches(worker, args):
+    # runs worker(*args[i], queue) in a fresh process per entry of args, in
+    # batches of cpu_count processes, and collects what each one puts in its queue
+    nrun = len(args)
+    nprocs = int(mp.cpu_count())
+    nbatch = int(np.floor(nrun / nprocs))
+    if nrun % nprocs:
+        nbatch += 1
+    res = []
+
+    # Each process will get a queue to put its result in it
+    queues = [mp.Queue() for p in range(nprocs)]
+
+    for b in range(nbatch):
+
+        # try running a batch until it works
+        while True:
+            try:
+                procs = []
+
+                ilow = b*nprocs
+                ihigh = min(nrun,(b+1)*nprocs)
+
+                for i in range(ilow, ihigh):
+                    p = mp.Process(
+                            target=worker,
+                            args=args[i]+tuple([queues[i-ilow]]))
+                    procs.append(p)
+                    p.start()
+
+                for i in range(ilow, ihigh):
+                    res += my_queue_get(queues[i-ilow]) # grab from this queue
+
+                # waits for worker to finish
+                for p in procs:
+                    p.join()
+                    p.terminate() # send SIGTERM just in case
+                    del p # remove the multiprocessing.Process
+
+                break # made it this far so break out of the while loop
+
+            except:
+                time.sleep(recovery_sleep_time_seconds) # wait a bit for processes to close before trying again
+
+    return res
+
+class WorkerPool(object):
+    """
+    Long-lived pool of worker processes for the parallel searches below, meant
+    to be created once per optimization instead of spawning processes per batch.
+
+    share(obj) publishes an object (the GP model) through shared memory.
+    Task arguments referring to it are then replaced by a small token, so
+    each worker unpickles it once per share call instead of once per task.
+    Calls that take longer than timeout seconds restart the pool and raise,
+    and exceptions raised in the workers are raised again in the caller.
+    """
+
+    def __init__(self, nprocs=None, timeout=60.):
+        self.nprocs = nprocs or int(mp.cpu_count())
+        self.timeout = timeout
+        self.pool = None # started on first use
+        self.shared = None # object currently published
+        self.shm = None
+        self.handle = None # (shared memory name, size, version) sent along with the tasks
+        self.version = 0
+
+    def start(self):
+        if self.pool is None:
+            self.pool = mp.Pool(self.nprocs)
+
+    def restart(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.start()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.unshare()
+
+    def share(self, obj):
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        self.unshare()
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        self.shm.buf[:len(data)] = data
+        self.version += 1
+        self.shared = obj
+        self.handle = (self.shm.name, len(data), self.version)
+
+    def unshare(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+        self.shm = None
+        self.shared = None
+        self.handle = None
+
+    def starmap(self, func, argslist, timeout=None, partial=False):
+        # returns [func(*args) for args in argslist], computed by the workers.
+        # With partial=True, running out of time is not an error: the tasks
+        # still running are cancelled and their results are None
+        self.start()
+        if timeout is None:
+            timeout = self.timeout
+        tasks = [(func, _packshared(args, self.shared), self.handle) for args in argslist]
+
+        if not partial:
+            result = self.pool.starmap_async(_runtask, tasks)
+            try:
+                return result.get(timeout)
+            except mp.TimeoutError:
+                # the workers may be stuck, replace them
+                self.restart()
+                raise Exception(f'WorkerPool: tasks did not finish within {timeout} s')
+
+        results = [None] * len(tasks)
+        deadline = time.time() + timeout
+        iresults = self.pool.imap_unordered(_runindexed, enumerate(tasks))
+        try:
+            for _ in tasks:
+                (i, res) = iresults.next(max(0., deadline - time.time()))
+                results[i] = res
+        except mp.TimeoutError:
+            # the only way to cancel running tasks is to replace the workers
+            self.restart()
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class _SharedToken(object):
+    # stands in for the shared object in the task arguments
+    pass
+
+def _packshared(args, shared):
+    if shared is None:
+        return args
+    if isinstance(args, tuple):
+        return tuple(_packshared(a, shared) for a in args)
+    if args is shared:
+        return _SharedToken()
+    return args
+
+def _unpackshared(args, shared):
+    if isinstance(args, tuple):
+        return tuple(_unpackshared(a, shared) for a in args)
+    if isinstance(args, _SharedToken):
+        return shared
+    return args
+
+_workershared = {'version': None, 'obj': None} # per worker process
+
+def _loadshared(handle):
+    (name, size, version) = handle
+    if _workershared['version'] != version:
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            _workershared['obj'] = pickle.loads(bytes(shm.buf[:size]))
+        finally:
+            shm.close()
+        _workershared['version'] = version
+    return _workershared['obj']
+
+def _runtask(func, args, handle):
+    if handle is not None:
+        args = _unpackshared(args, _loadshared(handle))
+    return func(*args)
+
+def _runindexed(task):
+    (i, (func, args, handle)) = task
+    return i, _runtask(func, args, handle)
+
+class DeadlineReached(Exception):
+    pass
+
+class DeadlineObjective(object):
+    """
+    Wraps a function to minimize, f(x, *args) returning either a value or
+    (value, gradient), so that it raises DeadlineReached once the wall clock
+    time passes deadline. Keeps the best point evaluated so far in xbest, fbest.
+    """
+
+    def __init__(self, f, deadline):
+        self.f = f
+        self.deadline = deadline
+        self.xbest = None
+        self.fbest = np.inf
+
+    def __call__(self, x, *args):
+        if time.time() > self.deadline:
+            raise DeadlineReached()
+        out = self.f(x, *args)
+        value = np.asarray(out[0] if isinstance(out, tuple) else out).item()
+        if value < self.fbest:
+            self.xbest = np.array(x, dtype=float)
+            self.fbest = value
+        return out
                     
 # see here https://eli.thegreenplace.net/2012/01/16/python-parallelizing-cpu-bound-tasks-with-multiprocessing/
 # and here https://stackoverflow.com/questions/37060091/multiprocessing-inside-function
@@ -27,22 +236,33 @@ try:
     
     from scipy.optimize import minimize
     
+    def minimizetask(f,x0,fargs,margs):
+        try:
+            res = minimize(f, x0, args = fargs, **margs)
+        except DeadlineReached:
+            # out of time, f is a DeadlineObjective that knows how far it got
+            if f.xbest is None:
+                return None
+            return [f.xbest, f.fbest]
+        return [res.x, np.asarray(res.fun).item()]
+
     def mworker(f,x0,fargs,margs,out_q):
         # worker invoked in a process puts the results in the output queue out_q
-    #    f,x0,fargs,margs = args
-        #print 'worker: fargs = ',fargs
-        #print 'worker: margs = ',margs
-        res = minimize(f, x0, args = fargs, **margs)
-        #return [res.x, res.fun]
-        out_q.put([[res.x, res.fun[0][0]]])
+        out_q.put([minimizetask(f,x0,fargs,margs)])
 
     # parallelize minimizations using different starting positions using multiprocessing, scipy.optimize.minimize
-    def parallelminimize(f,x0s,fargs,margs,v0best=None,relative_bounds=None):
+    def parallelminimize(f,x0s,fargs,margs,v0best=None,relative_bounds=None,pool=None,deadline=None):
         # f is fcn to minimize
         # x0s are positions to start search from
         # fargs are arguments to pass to f
         # margs are arguments to pass to scipy.optimize.minimize
+        # pool is an optional WorkerPool to run on instead of spawning processes
+        # deadline is an optional time.time() by which to stop searching and
+        #   return the best point found so far
         
+        if deadline is not None:
+            f = DeadlineObjective(f, deadline)
+
         # arguments to loop over
         if type(relative_bounds) is not type(None): # static bounds
             args = [(f,x,fargs,margs) for x in x0s]
@@ -52,76 +272,26 @@ try:
                 thesemargs = copy.copy(margs)
                 thesemargs['bounds'] = (x + relative_bounds.T).T # it works. deal with it.
                 args += [(f,x,fargs,thesemargs)]
-        #print '\n[arg[3][\'bounds\'] for arg in args] = \n', [arg[3]['bounds'] for arg in args], '\n'
-        
-        ## add relative bounds
-        #if type(relative_bounds) is not type(None):
-            #for i in range(len(args)):
-                #args[i][3]['bounds'] = args[i][1] + relative_bounds
-            #print '\n[arg[3][\'bounds\'] for arg in args] = \n', [arg[3]['bounds'] for arg in args], '\n'
-            ##print '\nargs = ', args, '\n'
 
         # https://stackoverflow.com/questions/9786102/how-do-i-parallelize-a-simple-python-loop#9786225
-        # also could try concurrent futures
-    #    import multiprocessing
-    #    pool = multiprocessing.Pool()
-    #    res = np.array(pool.map(minimizeone, args))
-    #    res = np.array(pool.map(l, range(10)))
-        
         # seems like this maybe be needed 
         # https://stackoverflow.com/questions/37060091/multiprocessing-inside-function
-                
-        worker = mworker
-        nrun = len(x0s)
-        nprocs = int(mp.cpu_count())# len(x0s)
-        nbatch = int(np.floor(nrun / nprocs))
-        if nrun % nprocs:
-            nbatch += 1
-        res = []
-        
-        # Each process will get a queue to put its result in it
-        queues = [mp.Queue() for p in range(nprocs)]
-
-        for b in range(nbatch):
-
-            # try running a batch until it works
-            while True:
-                try:
-                    procs = []
-                    
-                    ilow = b*nprocs
-                    ihigh = min(nrun,(b+1)*nprocs)
-                        
-                    #print 'launching processes'
-
-                    for i in range(ilow, ihigh):
-                        p = mp.Process(
-                                target=worker,
-                                args=args[i]+tuple([queues[i-ilow]]))
-                        procs.append(p)
-                        p.start()
-                        
-                    #print 'collecting results'
-
-                    for i in range(ilow, ihigh):
-                        res += my_queue_get(queues[i-ilow]) # grab from this queue
-                        
-                    #print 'waiting for termination/cleanup'
-
-                    # waits for worker to finish
-                    for p in procs:
-                        p.join()
-                        p.terminate() # send SIGTERM just in case
-                        del p # remove the multiprocessing.Process
-                        
-                    #print 'done with batch ', b+1, ' of ', nbatch
-                    
-                    break # made it this far so break out of the while loop
-                
-                except:
-                    time.sleep(recovery_sleep_time_seconds) # wait a bit for processes to close before trying again
+        if pool is not None and deadline is not None:
+            # a little grace for the searches to notice the deadline themselves
+            res = pool.starmap(minimizetask, args, timeout=max(0., deadline - time.time()) + 0.5, partial=True)
+        elif pool is not None:
+            res = pool.starmap(minimizetask, args)
+        else:
+            res = spawnbatches(mworker, args)
+
+        # searches that ran out of time before evaluating anything
+        res = [r for r in res if r is not None]
+        if not len(res):
+            if v0best is None:
+                raise Exception('parallelminimize: no search finished before the deadline')
+            return np.array(v0best[:-1])
             
-        res = np.array(res)
+        res = np.array(res, dtype=object) # rows of [x, fun]
         #print 'res = ', res
         res = res[res[:,1]==np.min(res[:,-1])][0]
         #print 'res = ', res
@@ -146,17 +316,21 @@ except:
     print('parallelstuff - WARNING: Could not load parallelminimize.')
     pass
 
+def maptask(f,x,fargs):
+    return f(x, *fargs)
+
 def mapworker(f,x,fargs,out_q):
     # worker invoked in a process puts the results in the output queue out_q
     #print 'f = ',f,'\tx = ',x,'\tfargs = ',fargs,'\tf(x, *fargs) = ',f(x, *fargs)
     #out_q.put([[x,f(x, *fargs)]])
-    out_q.put([[f(x, *fargs)]])
+    out_q.put([[maptask(f,x,fargs)]])
 
 # yuno stock have python?!
-def parallelmap(f,xs,fargs):
+def parallelmap(f,xs,fargs,pool=None):
     # f is fcn to map to
     # xs is list of coords to eval
     # fargs is a tuple of common arguments to pass to f
+    # pool is an optional WorkerPool to run on instead of spawning processes
     
     # arguments to loop over
     
@@ -166,61 +340,11 @@ def parallelmap(f,xs,fargs):
     
     # seems like this maybe be needed 
     # https://stackoverflow.com/questions/37060091/multiprocessing-inside-function
-        
-    worker = mapworker
-    nrun = len(xs)
-    nprocs = int(mp.cpu_count())# len(x0s)
-    nbatch = int(np.floor(nrun / nprocs))
-    if nrun % nprocs:
-        nbatch += 1
-    res = []
-    
-    # Each process will get a queue to put its result in it
-    queues = [mp.Queue() for p in range(nprocs)]
-
-    for b in range(nbatch):
-
-        # try running a batch until it works
-        while True:
-            try:
-                procs = []
-                
-                ilow = b*nprocs
-                ihigh = min(nrun,(b+1)*nprocs)
-                    
-                #print 'launching processes'
-
-                for i in range(ilow, ihigh):
-                    p = mp.Process(
-                            target=worker,
-                            args=args[i]+tuple([queues[i-ilow]]))
-                    procs.append(p)
-                    p.start()
-                    
-                #print 'collecting results'
+    if pool is not None:
+        return [[r] for r in pool.starmap(maptask, args)]
 
-                for i in range(ilow, ihigh):
-                    res += my_queue_get(queues[i-ilow]) # grab from this queue
-                    
-                #print 'waiting for termination/cleanup'
-
-                # waits for worker to finish
-                for p in procs:
-                    p.join()
-                    p.terminate() # send SIGTERM just in case
-                    del p # remove the multiprocessing.Process
-                    
-                #print 'done with batch ', b+1, ' of ', nbatch
-                    
-                break # made it this far so break out of the while loop
-            
-            except:
-                time.sleep(recovery_sleep_time_seconds) # wait a bit for processes to close before trying again
-        
-    # sort by argument order passed (seems presorted but just in case)
-    #res = res[res[:,0].argsort()] # this doesn't work in genreal; must mix back in xs for slicing
-
-    return res 
+    # returned in the order passed since each batch is collected queue by queue
+    return spawnbatches(mapworker, args)
 
 # #try testing parallelmap with this
 def testparallelmap(njobs=10, sleepmax=10.e-3): # sleepmax is maximum random sleep time in seconds
@@ -334,19 +458,30 @@ try:
     #from hammersley import hammersley
     from .chaospy_sequences import create_hammersley_samples
         
+    def evaltask(f,x,fargs):
+        res = f(x, *fargs)
+        return np.hstack((x, np.asarray(res).item()))
+
     def eworker(f,x,fargs,out_q):
         # worker invoked in a process puts the results in the output queue out_q
-        res = f(x, *fargs)
-        out_q.put(np.hstack((x, res[0][0])))
+        out_q.put([evaltask(f,x,fargs)])
+
+    def evalchunk(f,xs,fargs):
+        # f evaluates all the rows of xs in one call
+        return np.hstack((xs, np.reshape(f(xs, *fargs), (-1,1))))
 
     # eval function over a range of initial points neval and return the nkeep lowest function evals
-    def parallelgridsearch(f,x0,lengths,fargs,neval,nkeep):
+    def parallelgridsearch(f,x0,lengths,fargs,neval,nkeep,pool=None,vectorizedQ=True,chunksize=2048):
         # f is fcn to minimize
         # x0 is center of the search
         # lengths is an array of length scales
         # fargs are arguments to pass to f
         # neval is the number of points to evaluate the function on
         # nkeep is the number of the neval points to keep
+        # pool is an optional WorkerPool to run on instead of spawning processes
+        # vectorizedQ: f takes all the points as rows at once, so the grid is
+        #   evaluated in one call (or in chunks of chunksize points across the
+        #   pool workers if there are many). Otherwise one call per point
         
         if nkeep > neval: nkeep = neval
         
@@ -360,74 +495,25 @@ try:
         x0s = np.transpose(np.array(lengths,ndmin=2).T * x0s.T) # scale each dimension by it's lenghth scale
         x0s = x0s + x0 # shift to recenter
         
-        # arguments to loop over
-        # Each process will get a queue to put its result in it
-        args = [(f,x,fargs) for x in x0s]
-
-        # https://stackoverflow.com/questions/9786102/how-do-i-parallelize-a-simple-python-loop#9786225
-        # also could try concurrent futures
-    #    import multiprocessing
-    #    pool = multiprocessing.Pool()
-    #    res = np.array(pool.map(minimizeone, args))
-    #    res = np.array(pool.map(l, range(10)))
-        
-        # seems like this maybe be needed 
-        # https://stackoverflow.com/questions/37060091/multiprocessing-inside-function
-            
-        worker = eworker
-        nrun = neval
-        nprocs = int(mp.cpu_count())
-        nbatch = int(np.floor(nrun / nprocs))
-        if nrun % nprocs:
-            nbatch += 1
-        res = []
-        
-        # Each process will get a queue to put its result in it
-        queues = [mp.Queue() for p in range(nprocs)]
-
-        for b in range(nbatch):
+        if vectorizedQ:
+            nchunk = min(pool.nprocs if pool is not None else 1, int(np.ceil(neval / chunksize)))
+            if nchunk > 1:
+                chunks = np.array_split(x0s, nchunk)
+                res = np.vstack(pool.starmap(evalchunk, [(f,xs,fargs) for xs in chunks]))
+            else:
+                res = evalchunk(f,x0s,fargs)
 
-            # try running a batch until it works
-            while True:
-                try:
-                    procs = []
-                    
-                    ilow = b*nprocs
-                    ihigh = min(nrun,(b+1)*nprocs)
-                        
-                    #print 'launching processes'
-
-                    for i in range(ilow, ihigh):
-                        p = mp.Process(
-                                target=worker,
-                                args=args[i]+tuple([queues[i-ilow]]))
-                        procs.append(p)
-                        p.start()
-                        
-                    #print 'collecting results'
-                        
-                    if len(res):
-                        for i in range(ilow, ihigh):
-                            res = np.vstack((res,my_queue_get(queues[i-ilow])))
-                    else:
-                        res = np.array(my_queue_get(queues[0]))
-                        for i in range(ilow+1, ihigh):
-                            res = np.vstack((res,my_queue_get(queues[i-ilow])))
-                        
-                    #print 'waiting for termination/cleanup'
-
-                    # waits for worker to finish
-                    for p in procs:
-                        p.join() # wait until close
-                        p.terminate() # send SIGTERM just in case
-                        del p # remove the multiprocessing.Process
-                        
-                    #print 'done with batch ', b+1, ' of ', nbatch
-                    
-                    break # made it this far so break out of the while loop
-                
-                except:
-                    time.sleep(recovery_sleep_time_seconds) # wait a bit for processes to close before trying again
+        else:
+            # arguments to loop over
+            args = [(f,x,fargs) for x in x0s]
+
+            # https://stackoverflow.com/questions/9786102/how-do-i-parallelize-a-simple-python-loop#9786225
+            # seems like this maybe be needed 
+            # https://stackoverflow.com/questions/37060091/multiprocessing-inside-function
+            if pool is not None:
+                res = pool.starmap(evaltask, args)
+            else:
+                res = spawnbatches(eworker, args)
 
         ## return nkeep smallest values
         #res = np.array(res)
@@ -0,0 +1,176 @@
+# -*- coding: iso-8859-1 -*-
+"""
+Scan parameter files in npz format, which load without unpickling.
+
+A scan parameter file holds the dict made by make_scan_params_file.py:
+    gp_precisionmat: (ndim x ndim) precision matrix of the GP kernel, or
+        gp_lengthscales: (ndim) length scales of a diagonal one
+    gp_amp, gp_noise: GP amplitude and noise std dev
+    dev_ids: names of the ndim control devices
+    start_point: (ndim) settings to start from, None for the current ones
+    ucb_params: [nu, delta] of the UCB acquisition function, delta may be None
+    acquisition_delay, offset: seconds between evaluations, objective offset
+Other numeric entries are kept as they are.
+
+In the npz file, a None start_point is left out and a None in ucb_params is
+stored as NaN, so all entries are plain arrays.
+
+The old pickled .npy (advanced_bo) and .pkl (simplex_advanced) files are not
+read at runtime, since unpickling can run arbitrary code. Convert the ones you
+trust from the algorithms directory with
+
+    python -m advanced_bo.modules.scan_params advanced_bo/params/*.npy
+
+which writes an .npz file next to each of them.
+"""
+
+import os
+import sys
+import pickle
+import numpy as np
+
+# entries of the .pkl files of simplex_advanced
+_PKL_NAMES = {'precision_matrix': 'gp_precisionmat', 'amp': 'gp_amp',
+              'noise': 'gp_noise', 'offset': 'offset'}
+
+
+def save_scan_params(path, scan_params):
+    # writes the scan_params dict to an npz file, after validating it
+    scan_params = validate_scan_params(dict(scan_params))
+    arrays = {}
+    for (key, value) in scan_params.items():
+        if key == 'start_point' and value is None:
+            continue
+        if key == 'ucb_params':
+            value = [np.nan if v is None else v for v in value]
+        if key == 'dev_ids':
+            value = np.array(value, dtype=str)
+        arrays[key] = np.asarray(value)
+    np.savez(path, **arrays)
+
+
+def load_scan_params(path, keys=()):
+    # reads a scan_params dict from an npz file and validates it, keys are
+    #   the entries the caller needs on top of the GP hyperparameters
+    with np.load(path, allow_pickle=False) as data:
+        scan_params = dict((key, data[key]) for key in data.files)
+
+    for (key, value) in scan_params.items():
+        if value.ndim == 0:
+            scan_params[key] = value.item()
+    if 'dev_ids' in scan_params:
+        scan_params['dev_ids'] = [str(v) for v in scan_params['dev_ids']]
+    if 'ucb_params' in scan_params:
+        scan_params['ucb_params'] = [None if np.isnan(v) else float(v)
+                                     for v in scan_params['ucb_params']]
+    scan_params.setdefault('start_point', None)
+
+    return validate_scan_params(scan_params, path, keys)
+
+
+def validate_scan_params(scan_params, path='scan params', keys=()):
+    # checks that the keys are there and the entries have consistent shapes
+    #   and sensible values, returns the dict with the arrays as float arrays
+
+    def fail(message):
+        raise Exception(f'Invalid {path}: {message}')
+
+    missing = [key for key in keys if key not in scan_params]
+    if missing:
+        fail(f'missing {missing}')
+
+    if 'gp_precisionmat' in scan_params:
+        P = np.asarray(scan_params['gp_precisionmat'], dtype=float)
+        if P.ndim != 2 or P.shape[0] != P.shape[1]:
+            fail(f'gp_precisionmat must be a square matrix, not of shape {P.shape}')
+        if not np.all(np.isfinite(P)) or np.any(P.diagonal() <= 0):
+            fail('gp_precisionmat must be finite with a positive diagonal')
+        scan_params['gp_precisionmat'] = P
+        ndim = P.shape[0]
+    elif 'gp_lengthscales' in scan_params:
+        lengths = np.asarray(scan_params['gp_lengthscales'], dtype=float)
+        if lengths.ndim != 1 or not np.all(lengths > 0):
+            fail('gp_lengthscales must be a vector of positive lengths')
+        scan_params['gp_lengthscales'] = lengths
+        ndim = lengths.size
+    else:
+        fail('needs gp_precisionmat or gp_lengthscales')
+
+    for key in ['gp_amp', 'gp_noise']:
+        if key not in scan_params:
+            fail(f'needs {key}')
+        if not np.ndim(scan_params[key]) == 0 or not scan_params[key] > 0:
+            fail(f'{key} must be a positive number, not {scan_params[key]}')
+
+    if scan_params.get('start_point') is not None:
+        start_point = np.asarray(scan_params['start_point'], dtype=float).ravel()
+        if start_point.size != ndim or not np.all(np.isfinite(start_point)):
+            fail(f'start_point must be {ndim} finite numbers')
+        scan_params['start_point'] = start_point
+
+    if 'dev_ids' in scan_params and len(scan_params['dev_ids']) != ndim:
+        fail(f'{len(scan_params["dev_ids"])} dev_ids for {ndim} dimensions')
+
+    if 'ucb_params' in scan_params:
+        ucb_params = scan_params['ucb_params']
+        if len(ucb_params) != 2 or ucb_params[0] is None:
+            fail(f'ucb_params must be [nu, delta], not {ucb_params}')
+
+    if scan_params.get('acquisition_delay', 0) < 0:
+        fail('acquisition_delay must not be negative')
+
+    return scan_params
+
+
+def read_legacy_scan_params(path):
+    # reads an old pickled .npy or .pkl file into the scan_params layout,
+    #   for convert_scan_params only. This unpickles the file, only use it
+    #   on files you trust
+    if path.endswith('.npy'):
+        return dict(np.load(path, allow_pickle=True).item())
+
+    with open(path, 'rb') as f:
+        raw = pickle.load(f, encoding='bytes')
+    raw = dict((k.decode() if isinstance(k, bytes) else k, v) for (k, v) in raw.items())
+
+    # device entries are named after the device, their values are length
+    #   scales when there is no precision matrix
+    scan_params = dict((_PKL_NAMES[k], v) for (k, v) in raw.items() if k in _PKL_NAMES)
+    dev_ids = sorted(k for k in raw if k.endswith('Curr1'))
+    scan_params['dev_ids'] = dev_ids
+    if 'gp_precisionmat' not in scan_params:
+        scan_params['gp_lengthscales'] = np.array([raw[k] for k in dev_ids], dtype=float)
+    return scan_params
+
+
+def read_scan_params(path, keys=()):
+    # reads the npz scan params at path, which may leave out the extension.
+    #   An old pickled .npy or .pkl file is not read, but pointed out to be
+    #   converted
+    (base, ext) = os.path.splitext(path)
+    if ext not in ['.npz', '.npy', '.pkl']:
+        (base, ext) = (path, '')
+    if ext in ['', '.npz'] and os.path.exists(base + '.npz'):
+        return load_scan_params(base + '.npz', keys)
+
+    for legacy in ([ext] if ext else ['.npy', '.pkl']):
+        if legacy in ['.npy', '.pkl'] and os.path.exists(base + legacy):
+            raise Exception(f'{base + legacy} is a pickled scan params file, which is '
+                            f'not loaded for safety. If you trust it, convert it with '
+                            f'python -m advanced_bo.modules.scan_params {base + legacy}')
+
+    raise Exception(f'No scan params file found at {path}')
+
+
+def convert_scan_params(path, out=None):
+    # converts an old pickled .npy or .pkl file to npz, next to it unless
+    #   out is given, and returns the path of the npz file
+    if out is None:
+        out = os.path.splitext(path)[0] + '.npz'
+    save_scan_params(out, read_legacy_scan_params(path))
+    return out
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        print(f'{path} -> {convert_scan_params(path)}')
@@ -1,11 +1,34 @@
 import os
-import pickle
 import numpy as np
 import scipy.optimize as sopt
 from operator import itemgetter
 import logging
 
 
+def load_lengthscales(full_path):
+    # GP length scales of the scan, from the .npz scan params file (see
+    # advanced_bo.modules.scan_params). Old pickled .pkl files are not loaded
+    if not os.path.exists(f'{full_path}.npz'):
+        if os.path.exists(f'{full_path}.pkl'):
+            raise Exception(f'{full_path}.pkl is a pickled scan params file, which is '
+                            f'not loaded for safety. If you trust it, convert it with '
+                            f'python -m advanced_bo.modules.scan_params {full_path}.pkl')
+        raise Exception(f'No scan params file found at {full_path}.npz')
+
+    with np.load(f'{full_path}.npz', allow_pickle=False) as scan_params:
+        if 'gp_precisionmat' in scan_params.files:
+            gp_lengthscales = np.diag(scan_params['gp_precisionmat']) ** (-0.5)
+        elif 'gp_lengthscales' in scan_params.files:
+            gp_lengthscales = scan_params['gp_lengthscales'].astype(float)
+        else:
+            raise Exception(f'{full_path}.npz has neither gp_precisionmat nor gp_lengthscales')
+
+    if gp_lengthscales.ndim != 1 or not np.all(np.isfinite(gp_lengthscales)):
+        raise Exception(f'Invalid length scales in {full_path}: {gp_lengthscales}')
+
+    return gp_lengthscales
+
+
 def optimize(evaluate, params):
     start_from_current, x0, scan_params_name, xtol, max_iter = \
         itemgetter('start_from_current', 'x0', 'scan_params_name', 'xtol', 'max_iter')(params)
@@ -20,24 +43,16 @@ def optimize(evaluate, params):
 
     assert len(x0) == D, 'Dimension does not match!'
 
-    # Load the dict that contains the parameters for the scan
-    scan_params_filename = f'{scan_params_name}.pkl'
+    # Load the length scales from the parameters for the scan
     algo_root = os.path.dirname(os.path.realpath(__file__))
-    if scan_params_filename.startswith('/'):
-        full_path = scan_params_filename
+    if scan_params_name.startswith('/'):
+        full_path = scan_params_name
     else:
-        full_path = os.path.join(algo_root, 'params', scan_params_filename)
-    with open(full_path, 'rb') as f:
-        scan_params = pickle.load(f, encoding='bytes')
+        full_path = os.path.join(algo_root, 'params', scan_params_name)
+    gp_lengthscales = load_lengthscales(full_path)
+    assert len(gp_lengthscales) == D, 'Dimension does not match the scan params!'
 
     # Generate the initial simplex
-    try:
-        gp_precisionmat = scan_params[b'precision_matrix']
-        gp_lengthscales = np.diag(gp_precisionmat) ** (-0.5)
-    except:
-        keylist = scan_params.keys()
-        keylist.sort()
-        gp_lengthscales = np.array([scan_params[k] for k in keylist if k[-5:] == 'Curr1'])
     gp_lengthscales *= np.sign(np.random.randn(gp_lengthscales.size))
 
     isim =np.zeros((len(gp_lengthscales) + 1, len(gp_lengthscales)))
@@ -2,8 +2,11 @@ import time
 import numpy as np
 from badger import environment
 from badger.interface import Interface
-from badger.stats import percent_80
 import logging
+from .utils import compute_stats, scalar_stats, stats_percentiles
+
+PULSEID_MODULO = 131040  # pulse ids count the 360 Hz fiducials and wrap around
+FIDUCIAL_RATE = 360  # in Hz
 
 
 class Environment(environment.Environment):
@@ -14,8 +17,20 @@ class Environment(environment.Environment):
         super().__init__(interface, params)
 
         self.pv_limits = {}
+        self.moved_from = {}  # setpoints before the latest move, and its time
+        self.move_time = None
+        self.stats = {}  # all the stats of the latest readout of each observable
         # self.update_pvs_limits()  # don't do it here, it's too heavy
 
+        # Connecting is cheap if done all at once though
+        if self.params['warm_up']:
+            failed = self.interface.warm_up(self._list_channels())
+            if failed:
+                logging.warn(f'Failed to connect to: {failed}')
+
+        # The beam rate barely changes, no need to read it for every shot count
+        self.interface.monitor('EVNT:SYS0:1:LCLSBEAMRATE', max_age=60)
+
     @staticmethod
     def list_vars():
         return [
@@ -84,11 +99,43 @@ class Environment(environment.Environment):
             'points': 120,
             'losses_fname': None,
             'stats': 'percent_80',
+            'percentiles': [80],  # provided as percent_<q> stats
+            'trim': 0.1,  # fraction cut on each side for trimmed_mean
             'beamsize_monitor': '541',
             'use_check_var': True,  # if check var reaches the target value
             'trim_delay': 3,  # in second
+            'settle': True,  # wait for the readbacks instead of the full trim_delay
+            'settle_fraction': 0.02,  # of the step, between the readback and the setpoint
+            'settle_atol': 1e-4,  # lower bound of the settle tolerance
+            'settle_min_delay': 0.5,  # in second, shortest wait after a move
+            'warm_up': True,  # connect to all the channels at construction
         }
 
+    def _list_channels(self):
+        # All the channels used by the variables and observables
+        channels = []
+        for var in self.list_vars():
+            channels += [var, var + '.DRVL', var + '.DRVH']
+            if var.endswith(':BCTRL'):
+                prefix = var[:var.rfind(':')]
+                channels += [prefix + ':BACT', prefix + ':STATCTRLSUB.T']
+
+        mid = self.params['beamsize_monitor']
+        channels += [
+            'BEND:DMPH:400:BDES',
+            'SIOC:SYS0:ML00:CALC252',
+            'BLEN:LI24:886:BIMAX',
+            'EVNT:SYS0:1:LCLSBEAMRATE',
+            f'OTRS:IN20:{mid}:XRMS',
+            f'OTRS:IN20:{mid}:YRMS',
+            'GDET:FEE1:241:ENRCHSTCUHBR',
+            'EM1K0:GMD:HPS:milliJoulesPerPulse',
+            'EM1K0:GMD:HPS:milliJoulesPerPulseHSTCUSBR',
+            'PATT:SYS0:1:PULSEID',
+        ]
+
+        return channels
+
     def _get_vrange(self, var):
         try:
             vrange = self.pv_limits[var]
@@ -109,7 +156,19 @@ class Environment(environment.Environment):
         return self.interface.get_value(readback)
 
     def _set_var(self, var, x):
-        self.interface.set_value(var, x)
+        self._set_vars([var], [x])
+
+    def _set_vars(self, vars, values):
+        # Move all the magnets at once, so the step takes as long as
+        # the slowest magnet rather than the sum of all of them. The
+        # setpoints moved from size the settle tolerance in vars_changed
+        if self.params['settle']:
+            self.moved_from = dict(zip(vars, self.interface.get_values(vars)))
+        self.move_time = time.time()
+        if len(vars) == 1:
+            self.interface.set_value(vars[0], values[0])
+        else:
+            self.interface.set_values(vars, values)
 
     def _check_var(self, var):
         if not self.params['use_check_var']:
@@ -123,7 +182,46 @@ class Environment(environment.Environment):
         return self.interface.get_value(flag)
 
     def vars_changed(self, vars, values):
-        time.sleep(self.params['trim_delay'])  # extra time for stablizing orbits
+        if not self.params['settle']:
+            time.sleep(self.params['trim_delay'])  # extra time for stablizing orbits
+            return
+
+        # Return as soon as all the moved magnets report in tolerance,
+        # the trim delay becomes the upper bound of the wait. Only readouts
+        # that came after the move count, otherwise a magnet that has not
+        # started moving yet (or a trim flag still 0 from before) would pass
+        fraction = self.params['settle_fraction']
+        atol = self.params['settle_atol']
+        conditions = {}
+        for var, x in zip(vars, values):
+            if not var.endswith(':BCTRL'):
+                continue
+
+            x_old = self.moved_from.get(var)
+            if x_old is not None and x == x_old:
+                continue  # not moved, no readback update is coming
+
+            step = abs(x - x_old) if x_old is not None else 0
+            tol = max(fraction * step, atol)
+            prefix = var[:var.rfind(':')]
+            conditions[prefix + ':BACT'] = \
+                lambda value, x=x, tol=tol: abs(value - x) <= tol
+            if self.params['use_check_var']:
+                conditions[prefix + ':STATCTRLSUB.T'] = lambda value: value == 0
+
+        since = self.move_time
+        if conditions:
+            # Without any readout after the move, this waits the full trim delay
+            _, unsettled = self.interface.wait_until(
+                conditions, timeout=self.params['trim_delay'], since=since)
+            if unsettled:
+                logging.warning(f'Not settled within the trim delay: {unsettled}')
+
+        dwell = self.params['settle_min_delay']
+        if since is not None:
+            dwell -= time.time() - since
+        if dwell > 0:
+            time.sleep(dwell)
 
     def _get_obs(self, obs):
         mid = self.params['beamsize_monitor']
@@ -153,129 +251,133 @@ class Environment(environment.Environment):
             points = self.params['points']
             logging.info(f'Get Value of {points} points')
 
-            try:
-                rate = self._get_obs('beamrate')
-                logging.info(f'Beam rate: {rate}')
-                nap_time = points / (rate * 1.0)
-            except Exception as e:
-                nap_time = 1
-                logging.warn(
-                    'Something went wrong with the beam rate calculation. Let\'s sleep 1 second.')
-                logging.warn(f'Exception was: {e}')
-
-            time.sleep(nap_time)
+            self._wait_for_shots(points)
 
             data_raw = self.interface.get_value('GDET:FEE1:241:ENRCHSTCUHBR')
-            try:
-                data = data_raw[-points:]
-                obj_tar = percent_80(data)
-                obj_mean = np.mean(data)
-                obj_stdev = np.std(data)
-            except:  # if average fails use the scalar input
-                logging.warn(
-                    'Detector is not a waveform PV, using scalar value')
-                obj_tar = data_raw
-                obj_mean = data_raw
-                obj_stdev = -1
-
-            stats_dict = {
-                'percent_80': obj_tar,
-                'mean': obj_mean,
-                'stdev': obj_stdev,
-            }
-
-            return stats_dict[self.params['stats']]
+
+            return self._get_stats(obs, data_raw, data_raw)
         elif obs == 'sxr_pulse_intensity':
             # At lcls the repetition is 120 Hz and the readout buf size is 2800.
             # The last 120 entries correspond to pulse energies over past 1 second.
             points = self.params['points']
             logging.info(f'Get Value of {points} points')
 
-            try:
-                rate = self._get_obs('beamrate')
-                logging.info(f'Beam rate: {rate}')
-                nap_time = points / (rate * 1.0)
-            except Exception as e:
-                nap_time = 1
-                logging.warn(
-                    'Something went wrong with the beam rate calculation. Let\'s sleep 1 second.')
-                logging.warn(f'Exception was: {e}')
-
-            time.sleep(nap_time)
+            self._wait_for_shots(points)
 
             data_scalar = self.interface.get_value('EM1K0:GMD:HPS:milliJoulesPerPulse')
             data_raw = self.interface.get_value('EM1K0:GMD:HPS:milliJoulesPerPulseHSTCUSBR')
-            try:
-                data = data_raw[-points:]
-                obj_tar = percent_80(data)
-                obj_mean = np.mean(data)
-                obj_stdev = np.std(data)
-            except:  # if average fails use the scalar input
-                logging.warn(
-                    'Detector is not a waveform PV, using scalar value')
-                obj_tar = data_scalar
-                obj_mean = data_scalar
-                obj_stdev = -1
-
-            stats_dict = {
-                'percent_80': obj_tar,
-                'mean': obj_mean,
-                'stdev': obj_stdev,
-            }
-
-            return stats_dict[self.params['stats']]
+
+            return self._get_stats(obs, data_raw, data_scalar)
         elif obs == 'pulse_id':
             return self.interface.get_value('PATT:SYS0:1:PULSEID')
 
+    def _get_stats(self, obs, data_raw, data_scalar):
+        # Compute every stat at once, so that switching stats can be
+        # served from self.stats without acquiring again
+        points = self.params['points']
+        percentiles = stats_percentiles(self.params['stats'], self.params['percentiles'])
+        try:
+            stats = compute_stats(data_raw[-points:], percentiles, self.params['trim'])
+        except:  # if average fails use the scalar input
+            logging.warn(
+                'Detector is not a waveform PV, using scalar value')
+            stats = scalar_stats(data_scalar, percentiles)
+
+        self.stats[obs] = stats
+
+        return stats[self.params['stats']]
+
+    def _wait_for_shots(self, points):
+        # Wait until the history buffers hold points shots taken after now,
+        # by tracking the pulse id rather than sleeping points / rate
+        try:
+            rate = self._get_obs('beamrate')
+            logging.info(f'Beam rate: {rate}')
+            fiducials = points * FIDUCIAL_RATE / rate
+        except Exception as e:
+            logging.warn(
+                'Something went wrong with the beam rate calculation. Let\'s sleep 1 second.')
+            logging.warn(f'Exception was: {e}')
+            time.sleep(1)
+            return
+
+        pid0 = self.interface.get_value('PATT:SYS0:1:PULSEID')
+        _, unsettled = self.interface.wait_until(
+            {'PATT:SYS0:1:PULSEID':
+             lambda pid: (pid - pid0) % PULSEID_MODULO >= fiducials},
+            timeout=2 * fiducials / FIDUCIAL_RATE + 1)
+        if unsettled:
+            logging.warn(f'Pulse id did not advance by {fiducials} fiducials in time')
+
     def get_system_states(self):
         ignore_small_value = lambda x: x if x > 10 else 0
 
-        return {
-            'HXR electron energy [GeV]': self.interface.get_value('BEND:DMPH:400:BDES'),
-            'HXR photon energy [eV]': round(self.interface.get_value('SIOC:SYS0:ML00:AO627')),
-            'SXR electron energy [GeV]': self.interface.get_value('BEND:DMPS:400:BDES'),
-            'SXR photon energy [eV]': round(self.interface.get_value('SIOC:SYS0:ML00:AO628')),
+        # Read everything in one batch, the rate is the only string readout
+        scalars = [
+            'BEND:DMPH:400:BDES',
+            'SIOC:SYS0:ML00:AO627',
+            'BEND:DMPS:400:BDES',
+            'SIOC:SYS0:ML00:AO628',
+            'SIOC:SYS0:ML00:CALC038',
+            'SIOC:SYS0:ML00:CALC252',
+            'BPMS:DMPH:693:TMITCUH1H',
+            'BPMS:DMPS:693:TMITCUS1H',
+        ]
+        # All matching quads
+        quads = [
+            'QUAD:IN20:361:BCTRL',
+            'QUAD:IN20:371:BCTRL',
+            'QUAD:IN20:425:BCTRL',
+            'QUAD:IN20:441:BCTRL',
+            'QUAD:IN20:511:BCTRL',
+            'QUAD:IN20:525:BCTRL',
+            'QUAD:LI21:201:BCTRL',
+            'QUAD:LI21:211:BCTRL',
+            'QUAD:LI21:271:BCTRL',
+            'QUAD:LI21:278:BCTRL',
+            'QUAD:LI26:201:BCTRL',
+            'QUAD:LI26:301:BCTRL',
+            'QUAD:LI26:401:BCTRL',
+            'QUAD:LI26:501:BCTRL',
+            'QUAD:LI26:601:BCTRL',
+            'QUAD:LI26:701:BCTRL',
+            'QUAD:LI26:801:BCTRL',
+            'QUAD:LI26:901:BCTRL',
+            'QUAD:LTUH:620:BCTRL',
+            'QUAD:LTUH:640:BCTRL',
+            'QUAD:LTUH:660:BCTRL',
+            'QUAD:LTUH:680:BCTRL',
+            'QUAD:LTUS:620:BCTRL',
+            'QUAD:LTUS:640:BCTRL',
+            'QUAD:LTUS:660:BCTRL',
+            'QUAD:LTUS:680:BCTRL',
+            'QUAD:LI21:221:BCTRL',
+            'QUAD:LI21:251:BCTRL',
+            'QUAD:LI24:740:BCTRL',
+            'QUAD:LI24:860:BCTRL',
+            'QUAD:LTUH:440:BCTRL',
+            'QUAD:LTUH:460:BCTRL',
+            'QUAD:IN20:121:BCTRL',
+            'QUAD:IN20:122:BCTRL',
+        ]
+        values = dict(zip(scalars + quads,
+                          self.interface.get_values(scalars + quads)))
+
+        states = {
+            'HXR electron energy [GeV]': values['BEND:DMPH:400:BDES'],
+            'HXR photon energy [eV]': round(values['SIOC:SYS0:ML00:AO627']),
+            'SXR electron energy [GeV]': values['BEND:DMPS:400:BDES'],
+            'SXR photon energy [eV]': round(values['SIOC:SYS0:ML00:AO628']),
             'Rate [Hz]': self.interface.get_value('IOC:IN20:EV01:RG02_DESRATE', as_string=True),
-            'Charge at gun [pC]': ignore_small_value(self.interface.get_value('SIOC:SYS0:ML00:CALC038')),
-            'Charge after BC1 [pC]': ignore_small_value(self.interface.get_value('SIOC:SYS0:ML00:CALC252')),
-            'Charge at HXR dump [pC]': ignore_small_value(self.interface.get_value('BPMS:DMPH:693:TMITCUH1H') * 1.602e-7),
-            'Charge at SXR dump [pC]': ignore_small_value(self.interface.get_value('BPMS:DMPS:693:TMITCUS1H') * 1.602e-7),
-            # All matching quads
-            'QUAD:IN20:361:BCTRL': self.interface.get_value('QUAD:IN20:361:BCTRL'),
-            'QUAD:IN20:371:BCTRL': self.interface.get_value('QUAD:IN20:371:BCTRL'),
-            'QUAD:IN20:425:BCTRL': self.interface.get_value('QUAD:IN20:425:BCTRL'),
-            'QUAD:IN20:441:BCTRL': self.interface.get_value('QUAD:IN20:441:BCTRL'),
-            'QUAD:IN20:511:BCTRL': self.interface.get_value('QUAD:IN20:511:BCTRL'),
-            'QUAD:IN20:525:BCTRL': self.interface.get_value('QUAD:IN20:525:BCTRL'),
-            'QUAD:LI21:201:BCTRL': self.interface.get_value('QUAD:LI21:201:BCTRL'),
-            'QUAD:LI21:211:BCTRL': self.interface.get_value('QUAD:LI21:211:BCTRL'),
-            'QUAD:LI21:271:BCTRL': self.interface.get_value('QUAD:LI21:271:BCTRL'),
-            'QUAD:LI21:278:BCTRL': self.interface.get_value('QUAD:LI21:278:BCTRL'),
-            'QUAD:LI26:201:BCTRL': self.interface.get_value('QUAD:LI26:201:BCTRL'),
-            'QUAD:LI26:301:BCTRL': self.interface.get_value('QUAD:LI26:301:BCTRL'),
-            'QUAD:LI26:401:BCTRL': self.interface.get_value('QUAD:LI26:401:BCTRL'),
-            'QUAD:LI26:501:BCTRL': self.interface.get_value('QUAD:LI26:501:BCTRL'),
-            'QUAD:LI26:601:BCTRL': self.interface.get_value('QUAD:LI26:601:BCTRL'),
-            'QUAD:LI26:701:BCTRL': self.interface.get_value('QUAD:LI26:701:BCTRL'),
-            'QUAD:LI26:801:BCTRL': self.interface.get_value('QUAD:LI26:801:BCTRL'),
-            'QUAD:LI26:901:BCTRL': self.interface.get_value('QUAD:LI26:901:BCTRL'),
-            'QUAD:LTUH:620:BCTRL': self.interface.get_value('QUAD:LTUH:620:BCTRL'),
-            'QUAD:LTUH:640:BCTRL': self.interface.get_value('QUAD:LTUH:640:BCTRL'),
-            'QUAD:LTUH:660:BCTRL': self.interface.get_value('QUAD:LTUH:660:BCTRL'),
-            'QUAD:LTUH:680:BCTRL': self.interface.get_value('QUAD:LTUH:680:BCTRL'),
-            'QUAD:LTUS:620:BCTRL': self.interface.get_value('QUAD:LTUS:620:BCTRL'),
-            'QUAD:LTUS:640:BCTRL': self.interface.get_value('QUAD:LTUS:640:BCTRL'),
-            'QUAD:LTUS:660:BCTRL': self.interface.get_value('QUAD:LTUS:660:BCTRL'),
-            'QUAD:LTUS:680:BCTRL': self.interface.get_value('QUAD:LTUS:680:BCTRL'),
-            'QUAD:LI21:221:BCTRL': self.interface.get_value('QUAD:LI21:221:BCTRL'),
-            'QUAD:LI21:251:BCTRL': self.interface.get_value('QUAD:LI21:251:BCTRL'),
-            'QUAD:LI24:740:BCTRL': self.interface.get_value('QUAD:LI24:740:BCTRL'),
-            'QUAD:LI24:860:BCTRL': self.interface.get_value('QUAD:LI24:860:BCTRL'),
-            'QUAD:LTUH:440:BCTRL': self.interface.get_value('QUAD:LTUH:440:BCTRL'),
-            'QUAD:LTUH:460:BCTRL': self.interface.get_value('QUAD:LTUH:460:BCTRL'),
-            'QUAD:IN20:121:BCTRL': self.interface.get_value('QUAD:IN20:121:BCTRL'),
-            'QUAD:IN20:122:BCTRL': self.interface.get_value('QUAD:IN20:122:BCTRL'),
+            'Charge at gun [pC]': ignore_small_value(values['SIOC:SYS0:ML00:CALC038']),
+            'Charge after BC1 [pC]': ignore_small_value(values['SIOC:SYS0:ML00:CALC252']),
+            'Charge at HXR dump [pC]': ignore_small_value(values['BPMS:DMPH:693:TMITCUH1H'] * 1.602e-7),
+            'Charge at SXR dump [pC]': ignore_small_value(values['BPMS:DMPS:693:TMITCUS1H'] * 1.602e-7),
         }
+        for quad in quads:
+            states[quad] = values[quad]
+
+        return states
 
     def update_pv_limits(self, eid):
         pv_low = eid + '.DRVL'
@@ -285,5 +387,10 @@ class Environment(environment.Environment):
         self.pv_limits[eid] = (low, high)
 
     def update_pvs_limits(self):
-        for eid in self.list_vars():
-            self.update_pv_limits(eid)
+        eids = self.list_vars()
+        channels = []
+        for eid in eids:
+            channels += [eid + '.DRVL', eid + '.DRVH']
+        limits = self.interface.get_values(channels)
+        for i, eid in enumerate(eids):
+            self.pv_limits[eid] = (limits[2 * i], limits[2 * i + 1])
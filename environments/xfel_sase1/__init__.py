@@ -2,6 +2,7 @@ import time
 import numpy as np
 from badger import environment
 from badger.interface import Interface
+from .utils import compute_stats, stats_percentiles
 
 
 class Environment(environment.Environment):
@@ -11,6 +12,9 @@ class Environment(environment.Environment):
     def __init__(self, interface: Interface, params):
         super().__init__(interface, params)
 
+        self.sases = np.empty(30)  # readouts for sases_average, reused
+        self.stats = {}  # all the stats of the latest readout of each observable
+
     limits_undulators = {
         'XFEL.FEL/UNDULATOR.SASE1/CAX.CELL10.SA1/FIELD.OFFSET': [-0.5, 0.5],
         'XFEL.FEL/UNDULATOR.SASE1/CAX.CELL11.SA1/FIELD.OFFSET': [-0.5, 0.5],
@@ -161,6 +165,8 @@ class Environment(environment.Environment):
     def get_default_params():
         return {
             'waiting_time': 1,
+            'stats': 'mean',
+            'align_trains': False,  # read the bpms on common trains instead of sleeping
         }
 
     def _get_var(self, var):
@@ -170,6 +176,13 @@ class Environment(environment.Environment):
     def _set_var(self, var, x):
         self.interface.set_value(var, x)
 
+    def _get_vars(self, vars):
+        return self.interface.get_values(vars)
+
+    def _set_vars(self, vars, values):
+        # Move all the undulator cells at once
+        self.interface.set_values(vars, values)
+
     def _get_obs(self, obs):
         try:
             dt = self.params['waiting_time']
@@ -192,13 +205,14 @@ class Environment(environment.Environment):
             return sa
 
         elif obs == 'sases_average':
-            values = []
-            for i in range(30):
+            for i in range(len(self.sases)):
                 sa1 = self.interface.get_value(
                     "XFEL.FEL/XGM/XGM.2643.T9/INTENSITY.SA1.RAW.TRAIN")
-                values.append(sa1)
+                self.sases[i] = np.mean(sa1)
                 time.sleep(0.1)
-            return np.mean(values)
+            self.stats[obs] = compute_stats(
+                self.sases, stats_percentiles(self.params['stats']))
+            return self.stats[obs][self.params['stats']]
 
         elif obs == 'beam_energy':
             try:
@@ -297,10 +311,15 @@ class Environment(environment.Environment):
             return target
 
     def read_bpms(self, bpms, nreadings):
+        # All the bpms of one reading are read concurrently, from a common
+        # train newer than the previous one if align_trains
         orbits = np.zeros((nreadings, len(bpms)))
+        train_id = None
         for i in range(nreadings):
-            for j, bpm in enumerate(bpms):
-                orbits[i, j] = self.interface.get_value(bpm)
-            time.sleep(0.1)
+            if self.params['align_trains']:
+                orbits[i], train_id = self.interface.get_train_values(bpms, train_id)
+            else:
+                orbits[i] = self.interface.get_values(bpms)
+                time.sleep(0.1)
         return np.mean(orbits, axis=0)
 
@@ -0,0 +1,68 @@
+import numpy as np
+
+STATS = ['median', 'mean', 'stdev', 'sem', 'trimmed_mean', 'mad']  # besides percent_<q>
+
+
+def sorted_percentile(data_sorted, qs):
+    # np.percentile with linear interpolation, on already sorted data
+    n = len(data_sorted)
+    pos = np.asarray(qs, dtype=float) / 100 * (n - 1)
+    lo = np.floor(pos).astype(int)
+    hi = np.minimum(lo + 1, n - 1)
+    return data_sorted[lo] + (pos - lo) * (data_sorted[hi] - data_sorted[lo])
+
+
+def compute_stats(data, percentiles=(80,), trim=0.1):
+    """Compute all the supported statistics of data in one go.
+
+    Returns a dict with percent_<q> for each q in percentiles, plus median,
+    mean, stdev, sem (standard error of the mean), trimmed_mean (mean
+    without the trim fraction of samples on each side) and mad (median
+    absolute deviation).
+    """
+    data = np.asarray(data, dtype=float).ravel()
+    n = len(data)
+
+    # One sort serves the percentiles, the median and the trimmed mean,
+    # only the absolute deviations for the MAD need another one
+    data_sorted = np.sort(data)
+    qs = list(percentiles) + [50]
+    values = sorted_percentile(data_sorted, qs)
+    median = values[-1]
+
+    k = int(trim * n)
+    stdev = np.std(data)
+
+    stats = {f'percent_{q}': v for q, v in zip(percentiles, values)}
+    stats['median'] = median
+    stats['mean'] = np.mean(data)
+    stats['stdev'] = stdev
+    stats['sem'] = np.std(data, ddof=1) / np.sqrt(n) if n > 1 else -1
+    stats['trimmed_mean'] = np.mean(data_sorted[k:n - k])
+    stats['mad'] = np.median(np.abs(data - median))
+
+    return stats
+
+
+def stats_percentiles(stats, percentiles=()):
+    """Return the percentiles to compute so that stats is among the results.
+
+    stats is either one of STATS or percent_<q>, in which case q is added to
+    percentiles if missing.
+    """
+    percentiles = list(percentiles)
+    if stats in STATS:
+        return percentiles
+
+    q = stats[len('percent_'):]
+    try:
+        q = int(q) if q.isdigit() else float(q)
+    except ValueError:
+        q = None
+    if not stats.startswith('percent_') or q is None or not 0 <= q <= 100:
+        raise Exception(f'Unknown stats {stats}, choose from {STATS} or percent_<q>')
+
+    if q not in percentiles:
+        percentiles.append(q)
+
+    return percentiles
@@ -1,3 +1,6 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 import pydoocs
 from badger import interface
 
@@ -9,14 +12,85 @@ class Interface(interface.Interface):
     def __init__(self, params=None):
         super().__init__(params)
 
+        self.pool = ThreadPoolExecutor(max_workers=self.params['max_workers'])
+
     @staticmethod
     def get_default_params():
-        return None
+        return {
+            'max_workers': 16,  # threads used by get_values/set_values
+            'timeout': 5,  # in second, default timeout of get_values/set_values
+        }
 
-    def get_value(self, channel: str):
+    def get_value(self, channel: str, with_id=False):
         val = pydoocs.read(channel)
 
+        if with_id:  # macropulse is the train id of the readout
+            return val['data'], val['macropulse']
+
         return val['data']
 
     def set_value(self, channel: str, value):
         pydoocs.write(channel, float(value))
+
+    def _run_all(self, func, args_list, channels, timeout):
+        # Fan the calls out over the pool and wait for them together
+        if timeout is None:
+            timeout = self.params['timeout']
+
+        futures = [self.pool.submit(func, *args) for args in args_list]
+        _, not_done = wait(futures, timeout)
+        if not_done:
+            # Queued calls can be cancelled, but a call that already runs
+            # can't be stopped and keeps its worker until pydoocs returns.
+            # Leave those workers to the old pool and start a fresh one, so
+            # that a hung channel doesn't starve the next calls
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = ThreadPoolExecutor(max_workers=self.params['max_workers'])
+            failed = [channel for channel, future in zip(channels, futures)
+                      if future in not_done]
+            stuck = [channel for channel, future in zip(channels, futures)
+                     if future in not_done and future.running()]
+            if stuck:
+                logging.warning(f'DOOCS calls still running after the timeout, '
+                                f'their threads are left behind: {stuck}')
+            raise Exception(f'DOOCS access timed out after {timeout}s: {failed}')
+
+        return [future.result() for future in futures]
+
+    def get_values(self, channels: list, with_id=False, timeout=None):
+        return self._run_all(self.get_value,
+                             [(channel, with_id) for channel in channels],
+                             channels, timeout)
+
+    def get_train_values(self, channels: list, last_id=None, timeout=1):
+        # Read all the channels from the same train, which has to be newer
+        # than last_id, by re-reading the ones that lag behind. Returns the
+        # values and their train id, raises if the readouts are still stale
+        # or misaligned after timeout seconds
+        readouts = self.get_values(channels, with_id=True)
+        deadline = time.time() + timeout
+        while True:
+            ids = [train_id for _, train_id in readouts]
+            target = max(ids)
+            stale = [j for j, train_id in enumerate(ids)
+                     if train_id != target or train_id == last_id]
+            if not stale:
+                break
+
+            if time.time() > deadline:
+                if target == last_id:
+                    raise Exception(f'No DOOCS readout newer than train {last_id} '
+                                    f'after {timeout}s')
+                raise Exception(f'DOOCS readouts not aligned on train {target} '
+                                f'after {timeout}s: {[channels[j] for j in stale]}')
+
+            time.sleep(0.01)
+            for j, readout in zip(stale, self.get_values(
+                    [channels[j] for j in stale], with_id=True)):
+                readouts[j] = readout
+
+        return [data for data, _ in readouts], target
+
+    def set_values(self, channels: list, values: list, timeout=None):
+        self._run_all(self.set_value, list(zip(channels, values)),
+                      channels, timeout)
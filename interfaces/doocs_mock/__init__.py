@@ -1,3 +1,4 @@
+import time
 from badger import interface
 
 from numpy import random
@@ -14,9 +15,26 @@ class Interface(interface.Interface):
     def get_default_params():
         return None
 
-    def get_value(self, channel: str):
+    def get_value(self, channel: str, with_id=False):
         print("Called get_value for channel: {}.".format(channel))
+        if with_id:
+            return random.random(), int(time.time() * 10)  # 10 Hz trains
+
         return random.random()
 
     def set_value(self, channel: str, value):
         print("Called set_value for channel: {}, with value: {}".format(channel, value))
+
+    def get_values(self, channels: list, with_id=False, timeout=None):
+        return [self.get_value(channel, with_id) for channel in channels]
+
+    def get_train_values(self, channels: list, last_id=None, timeout=1):
+        train_id = int(time.time() * 10)
+        if last_id is not None:
+            train_id = max(train_id, last_id + 1)
+
+        return self.get_values(channels), train_id
+
+    def set_values(self, channels: list, values: list, timeout=None):
+        for channel, value in zip(channels, values):
+            self.set_value(channel, value)
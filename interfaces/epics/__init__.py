@@ -1,4 +1,6 @@
 import time
+import threading
+from collections import Counter
 import numpy as np
 import epics
 from badger import interface
@@ -6,6 +8,36 @@ from badger import interface
 epics.ca.DEFAULT_CONNECTION_TIMEOUT = 0.1
 
 
+def validate(value, as_string=False):
+    # Return the cleaned readout, or None if it is not usable
+    if value is None:
+        return None
+
+    if as_string:
+        return value
+
+    try:
+        _ = len(value)
+        value = value[~np.isnan(value)]
+        if len(value):
+            return value
+    except:
+        if not np.isnan(value):
+            return value
+
+    return None
+
+
+def is_close(readback, value):
+    if readback is None:
+        return False
+
+    if value:
+        return np.all(np.isclose(readback, value, rtol=1e-3))
+    else:
+        return np.all(np.isclose(readback, value, atol=1e-3))
+
+
 class Interface(interface.Interface):
 
     name = 'epics'
@@ -15,17 +47,134 @@ class Interface(interface.Interface):
 
         self.pvs = {}  # epics pvs (not values!)
 
+        # Monitor cache: channel -> (value, time of the last confirmation)
+        self.cache = {}
+        self.max_ages = dict(self.params['max_ages'])
+        self.cache_hits = Counter()
+        self.cache_misses = Counter()
+
+        if self.params['channels']:
+            self.warm_up(self.params['channels'])
+
     @staticmethod
     def get_default_params():
-        return None
+        return {
+            'use_monitor': False,  # serve reads from CA monitors if fresh
+            'max_age': 10,  # in second, used for channels not in max_ages
+            'max_ages': {},  # per channel max age, these are always monitored
+            'channels': [],  # channels to connect to at construction
+        }
 
-    @interface.log
-    def get_value(self, channel: str, as_string=False):
+    def _get_pv(self, channel: str):
         try:
             pv = self.pvs[channel]
         except KeyError:
             pv = epics.get_pv(channel)
             self.pvs[channel] = pv
+            if self._is_monitored(channel):
+                pv.add_callback(self._on_update, channel=channel)
+
+        return pv
+
+    def _is_monitored(self, channel):
+        return self.params['use_monitor'] or (channel in self.max_ages)
+
+    def _on_update(self, channel=None, value=None, **kw):
+        # Runs in the CA thread whenever a monitored pv changes
+        self.cache[channel] = (value, time.time())
+
+    def _get_cached(self, channel):
+        # Return the cached value of a monitored channel if still fresh,
+        # None otherwise. Counts the hit/miss along the way
+        if not self._is_monitored(channel):
+            return None
+
+        max_age = self.max_ages.get(channel, self.params['max_age'])
+        try:
+            value, stamp = self.cache[channel]
+            if not self.pvs[channel].connected:
+                raise KeyError
+        except KeyError:
+            value = None
+        else:
+            if time.time() - stamp > max_age:
+                value = None
+
+        value = validate(value)
+        if value is None:
+            self.cache_misses[channel] += 1
+        else:
+            self.cache_hits[channel] += 1
+
+        return value
+
+    def _set_cached(self, channel, value):
+        # A synchronous readout also confirms the monitored value
+        if self._is_monitored(channel):
+            self.cache[channel] = (value, time.time())
+
+    def monitor(self, channel: str, max_age=None):
+        """Serve the reads of channel from a CA monitor from now on."""
+        if max_age is None:
+            max_age = self.params['max_age']
+
+        try:
+            pv = self.pvs[channel]
+        except KeyError:
+            self.max_ages[channel] = max_age
+            self._get_pv(channel)
+        else:
+            if not self._is_monitored(channel):
+                pv.add_callback(self._on_update, channel=channel)
+            self.max_ages[channel] = max_age
+
+    def get_cache_stats(self):
+        channels = set(self.cache_hits) | set(self.cache_misses)
+        return {channel: {'hits': self.cache_hits[channel],
+                          'misses': self.cache_misses[channel]}
+                for channel in sorted(channels)}
+
+    def _connect(self, channels, timeout=1):
+        # Create all the pvs first so that the connections are
+        # established in parallel, then wait on them with a shared deadline
+        pvs = [self._get_pv(channel) for channel in channels]
+
+        connected = {}
+        deadline = time.time() + timeout
+        for channel, pv in zip(channels, pvs):
+            if pv.wait_for_connection(max(deadline - time.time(), 0)):
+                connected[channel] = pv
+
+        return connected
+
+    def warm_up(self, channels: list, timeout=2):
+        """Connect to all the channels in parallel ahead of their first use.
+
+        Returns the list of channels that failed to connect within timeout.
+        """
+        connected = self._connect(channels, timeout)
+
+        return [channel for channel in channels if channel not in connected]
+
+    def _get_many(self, pvs, as_string=False):
+        # Issue all the CA gets before waiting for any of them
+        if as_string:
+            return [pv.get(as_string=True) for pv in pvs]
+
+        for pv in pvs:
+            epics.ca.get(pv.chid, wait=False)
+        epics.ca.poll()
+
+        return [epics.ca.get_complete(pv.chid) for pv in pvs]
+
+    @interface.log
+    def get_value(self, channel: str, as_string=False):
+        pv = self._get_pv(channel)
+
+        if not as_string:
+            value = self._get_cached(channel)
+            if value is not None:
+                return value
 
         if not pv.wait_for_connection(1):
             # TODO: consider throwing an exception here
@@ -34,48 +183,179 @@ class Interface(interface.Interface):
         count_down = 2  # second
         while count_down > 0:
             value = pv.get(as_string=as_string)
-            try:
-                _ = len(value)
-                value = value[~np.isnan(value)]
-                if len(value):
-                    return value
-            except:
-                if (value is not None) and (not np.isnan(value)):
-                    return value
+            _value = validate(value, as_string)
+            if _value is not None:
+                if not as_string:
+                    self._set_cached(channel, _value)
+                return _value
 
             time.sleep(0.1)
             count_down -= 0.1
 
         raise Exception(f'PV {channel} readout ({value}) is invalid!')
 
+    def get_values(self, channels: list, as_string=False):
+        # Channels that fail to connect read as None, same as get_value
+        results = {channel: None for channel in channels}
+        if not as_string:
+            for channel in channels:
+                self._get_pv(channel)
+                results[channel] = self._get_cached(channel)
+        missed = [channel for channel in channels if results[channel] is None]
+
+        pvs = self._connect(missed)
+        pending = list(pvs.keys())
+
+        count_down = 2  # second
+        while True:
+            raw = self._get_many([pvs[c] for c in pending], as_string)
+            invalid = []
+            for channel, value in zip(pending, raw):
+                _value = validate(value, as_string)
+                if _value is None:
+                    invalid.append((channel, value))
+                else:
+                    results[channel] = _value
+                    if not as_string:
+                        self._set_cached(channel, _value)
+
+            pending = [channel for channel, _ in invalid]
+            if not pending:
+                break
+
+            if count_down <= 0:
+                readouts = ', '.join(f'{c} ({v})' for c, v in invalid)
+                raise Exception(f'PV readouts are invalid: {readouts}!')
+
+            time.sleep(0.1)
+            count_down -= 0.1
+
+        return [results[channel] for channel in channels]
+
+    def wait_until(self, conditions: dict, timeout=2, since=None):
+        """Wait until every condition holds on the latest value of its channel.
+
+        conditions maps a channel to a callable that takes the channel value
+        and tells whether it is settled. The check is driven by CA monitor
+        callbacks, so this returns as soon as the last channel settles.
+        If since is given (a time.time() value), only values the IOC stamped
+        at or after it count, so a readout from before a put can't settle
+        its channel. Returns the latest values and the list of unsettled
+        channels.
+        """
+        pvs = self._connect(list(conditions.keys()))
+        values = {channel: None for channel in conditions}
+        # Channels that cannot connect never settle
+        disconnected = [channel for channel in conditions if channel not in pvs]
+        unsettled = set(pvs.keys())
+
+        lock = threading.Lock()
+        settled = threading.Event()
+
+        def check(channel=None, value=None, timestamp=None, **kw):
+            with lock:
+                values[channel] = value
+                if since is not None and (timestamp is None or timestamp < since):
+                    ok = False
+                else:
+                    try:
+                        ok = (value is not None) and bool(conditions[channel](value))
+                    except Exception:
+                        ok = False
+
+                if ok:
+                    unsettled.discard(channel)
+                else:
+                    unsettled.add(channel)
+
+                if not unsettled:
+                    settled.set()
+
+        indices = {}
+        try:
+            for channel, pv in pvs.items():
+                indices[channel] = pv.add_callback(check, channel=channel)
+
+            # Monitors only fire on changes, seed with the current values
+            # unless a monitor update already came in
+            if since is None:
+                current = self._get_many(list(pvs.values()))
+                for channel, value in zip(pvs.keys(), current):
+                    if values[channel] is None:
+                        check(channel, value)
+            else:
+                for channel, pv in pvs.items():
+                    data = pv.get_with_metadata(form='time', use_monitor=False)
+                    if data is not None and values[channel] is None:
+                        check(channel, data['value'], data.get('timestamp'))
+
+            if pvs:
+                settled.wait(timeout)
+        finally:
+            for channel, index in indices.items():
+                pvs[channel].remove_callback(index)
+
+        with lock:
+            return dict(values), sorted(unsettled) + disconnected
+
     @interface.log
     def set_value(self, channel: str, value):
-        try:
-            pv = self.pvs[channel]
-        except KeyError:
-            pv = epics.get_pv(channel)
-            self.pvs[channel] = pv
+        pv = self._get_pv(channel)
 
         if not pv.wait_for_connection(1):
             # TODO: consider throwing an exception here
             return None
 
         # Wait for no longer 5s
+        self.cache.pop(channel, None)
         pv.put(value, wait=True, timeout=3)
         # The following might not make sense
         # since usually we should set one channel but monitor
         # a corresponding but different channel
-        count_down = 2  # second
-        while count_down > 0:
-            _value = pv.get()
-            if value:
-                if np.isclose(_value, value, rtol=1e-3):
-                    return _value
-            else:
-                if np.isclose(_value, value, atol=1e-3):
-                    return _value
-
-            time.sleep(0.1)
-            count_down -= 0.1
+        values, unsettled = self.wait_until(
+            {channel: lambda _value: is_close(_value, value)}, timeout=2)
+        _value = values[channel]
+        if not unsettled:
+            return _value
 
         raise Exception(f'PV {channel} (current: {_value}) cannot reach expected value ({value})!')
+
+    def set_values(self, channels: list, values: list):
+        pvs = self._connect(channels)
+        targets = {channel: value for channel, value in zip(channels, values)
+                   if channel in pvs}
+
+        # Fire all the puts, then wait for them to complete together
+        lock = threading.Lock()
+        remaining = set(targets.keys())
+        completed = threading.Event()
+
+        def on_complete(data=None, **kw):
+            with lock:
+                remaining.discard(data)
+                if not remaining:
+                    completed.set()
+
+        for channel, value in targets.items():
+            self.cache.pop(channel, None)
+            pvs[channel].put(value, wait=False, callback=on_complete,
+                             callback_data=channel)
+
+        if targets:
+            completed.wait(3)
+
+        # Then one shared settle barrier for all the channels
+        conditions = {channel: lambda _value, value=value: is_close(_value, value)
+                      for channel, value in targets.items()}
+        readbacks, unsettled = self.wait_until(conditions, timeout=2)
+
+        # Report every failed channel, not just the first one
+        failures = {channel: 'not connected' for channel in channels
+                    if channel not in pvs}
+        for channel in unsettled:
+            failures[channel] = f'current: {readbacks[channel]}, expected: {targets[channel]}'
+        if failures:
+            msg = ', '.join(f'{c} ({reason})' for c, reason in failures.items())
+            raise Exception(f'PVs cannot reach expected values: {msg}!')
+
+        return [readbacks.get(channel) for channel in channels]
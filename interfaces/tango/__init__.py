@@ -1,3 +1,4 @@
+from collections import OrderedDict
 import tango
 from badger import interface
 
@@ -9,14 +10,65 @@ class Interface(interface.Interface):
     def __init__(self, params=None):
         super().__init__(params)
 
+        # (kind, name) -> proxy, least recently used first
+        self.proxies = OrderedDict()
+
     @staticmethod
     def get_default_params():
-        return None
+        return {
+            'max_proxies': 64,  # how many device/attribute proxies to keep
+        }
+
+    def _get_proxy(self, kind: str, name: str):
+        key = (kind, name)
+        try:
+            proxy = self.proxies.pop(key)
+        except KeyError:
+            if kind == 'device':
+                proxy = tango.DeviceProxy(name)
+            else:
+                proxy = tango.AttributeProxy(name)
+
+        self.proxies[key] = proxy
+        while len(self.proxies) > self.params['max_proxies']:
+            self.proxies.popitem(last=False)
+
+        return proxy
 
-    def get_value(self, channel: str, attr: str):
-        attr = tango.AttributeProxy(channel)
-        return attr.read().value
+    def _call(self, kind: str, name: str, func, write: bool = False):
+        # A cached proxy can go stale (device server restart etc.),
+        # in that case reconnect once with a fresh proxy. Only connection
+        # failures are retried, and for writes only those where the
+        # request never reached the device, so a value is never written twice
+        if write:
+            retry = tango.ConnectionFailed
+        else:
+            retry = (tango.ConnectionFailed, tango.CommunicationFailed)
+        try:
+            return func(self._get_proxy(kind, name))
+        except retry:
+            self.proxies.pop((kind, name), None)
+            return func(self._get_proxy(kind, name))
+
+    def get_value(self, channel: str, attr=None):
+        return self._call('attribute', channel, lambda proxy: proxy.read().value)
 
     def set_value(self, channel: str, value, attr: str):
-        dev = tango.DeviceProxy(channel)
-        dev.write_attribute(attr, value)
+        self._call('device', channel, lambda dev: dev.write_attribute(attr, value),
+                   write=True)
+
+    def get_values(self, channels: list):
+        # Group the attributes per device, then read each device at once
+        devices = OrderedDict()
+        for channel in channels:
+            device, attr = channel.rsplit('/', 1)
+            devices.setdefault(device, []).append(attr)
+
+        values = {}
+        for device, attrs in devices.items():
+            readouts = self._call('device', device,
+                                  lambda dev: dev.read_attributes(attrs))
+            for attr, readout in zip(attrs, readouts):
+                values[f'{device}/{attr}'] = readout.value
+
+        return [values[channel] for channel in channels]